@@ -1,9 +1,9 @@
 from layers.EditableLayer import EditableLayer, Substitute
 from fs.osfs import OSFS
-from pydash import py_
 
 from layers.StaticLayer import StaticLayer
-from libs.molecule_text import atoms_bonds_to_mol2
+from layers.DiffCombinator import DiffCombinator, SiteDiff
+from libs.molecule_text import molecule_to_text
 
 directory = OSFS("Substitutes")
 
@@ -13,28 +13,24 @@ template = OSFS("example_data").readtext("template.mol2")
 template_layer = StaticLayer(contains=(EditableLayer.from_mol2(template), []))
 
 to_replace = [
-    ("P11", ["H33", "H36"]),
-    ("P12", ["H34", "H35"])
+    ("P11", ["H35", "H36"]),
+    ("P12", ["H33", "H34"])
 ]
 
-diff_layer_groups = {}
+combinator = DiffCombinator(template_layer)
 
 for (entry_name, center_names) in to_replace:
-    diff_layers = []
-    for (_, substitute) in substitutes:
+    diffs = []
+    for (substitute_name, substitute) in substitutes:
         layer = EditableLayer(template_layer)
         entry_index = layer.find_with_classname(entry_name)[0]
         for center_name in center_names:      
             center_index = layer.find_with_classname(center_name)[0]
             layer.add_substitute(substitute, center_index, entry_index)
-        diff_layers.append(layer.detach_diff_layer())
-    diff_layer_groups[entry_name] = diff_layers
-
-alldiff = py_.flatten(py_.map(diff_layer_groups["P11"], lambda diff1: py_.map(diff_layer_groups["P12"], lambda diff2: [diff1, diff2])))
+        diffs.append((substitute_name, SiteDiff(template_layer, layer)))
+    combinator.add_site(entry_name, diffs)
 
 output = OSFS("output")
 
-for i, diffs in enumerate(alldiff):
-    layer = StaticLayer(contains=(template_layer, diffs))
-    mol2 = atoms_bonds_to_mol2(layer.atoms, layer.bonds)
-    output.writetext(f"{i}.mol2", mol2)
\ No newline at end of file
+for i, (layer, _) in enumerate(combinator):
+    output.writetext(f"{i}.mol2", molecule_to_text(layer.molecule))
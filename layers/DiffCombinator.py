@@ -0,0 +1,129 @@
+from itertools import product
+import numpy as np
+from libs.Molecule import Molecule, object_array
+from layers.StaticLayer import StaticLayer
+
+
+class SiteDiff:
+    """
+    `EditableLayer`相对其基础层(模板)的修改, 以模板行号表示:
+
+    - removed_rows: 被删除的模板原子
+    - modified_rows, modified_atoms: 被修改的模板原子及修改后的原子
+    - fragment: 新增的原子及其之间的键
+    - links, link_orders: 新增原子与模板原子之间的键, 每行为(模板行号, fragment行号)
+    - removed_bonds: 被删除或修改键级的模板键(模板键数组中的行号)
+    - template_bonds, template_bond_orders: 模板原子之间新增或修改的键
+    """
+
+    def __init__(self, template, editable) -> None:
+        molecule = template.molecule
+        index = molecule.index
+        atoms_patch, bonds_patch, _ = editable.state
+        added = {}
+        removed_rows, self.modified_rows, self.modified_atoms = [], [], []
+        for atom_id, atom in atoms_patch.items():
+            if atom_id not in index:
+                if atom is not None:
+                    added[atom_id] = atom
+            elif atom is None:
+                removed_rows.append(index[atom_id])
+            else:
+                self.modified_rows.append(index[atom_id])
+                self.modified_atoms.append(atom)
+        self.removed_rows = np.array(removed_rows, dtype="int64")
+        fragment_bonds, links, link_orders = {}, [], []
+        template_bond_rows = {
+            frozenset((int(a), int(b))): i for i, (a, b) in enumerate(molecule.bonds)
+        }
+        removed_bonds, template_bonds, template_bond_orders = [], [], []
+        for bond_id, order in bonds_patch.items():
+            a_added, b_added = bond_id.a in added, bond_id.b in added
+            if a_added and b_added:
+                fragment_bonds[bond_id] = order
+            elif a_added or b_added:
+                template_id, added_id = (bond_id.b, bond_id.a) if a_added else (bond_id.a, bond_id.b)
+                if order is not None and template_id in index:
+                    links.append((index[template_id], added_id))
+                    link_orders.append(order)
+            elif bond_id.a in index and bond_id.b in index:
+                rows = (index[bond_id.a], index[bond_id.b])
+                existed = template_bond_rows.get(frozenset(rows))
+                if existed is not None:
+                    removed_bonds.append(existed)
+                if order is not None:
+                    template_bonds.append(rows)
+                    template_bond_orders.append(order)
+        self.fragment = Molecule.from_atoms_bonds(added, fragment_bonds)
+        self.links = np.array(
+            [(template_row, self.fragment.index[added_id]) for template_row, added_id in links], dtype="int64"
+        ).reshape(-1, 2)
+        self.link_orders = object_array(link_orders)
+        self.removed_bonds = np.array(removed_bonds, dtype="int64")
+        self.template_bonds = np.array(template_bonds, dtype="int64").reshape(-1, 2)
+        self.template_bond_orders = object_array(template_bond_orders)
+
+
+class DiffCombinator:
+    """
+    组合多个位点的修改: 每个位点有若干个可选的`SiteDiff`(均相对同一模板计算), 逐个生成所有位点选项的笛卡尔积
+
+    每个组合只需将模板保留的部分与各选项的fragment按行号偏移拼接, 计算量与位点×选项的数目而非组合数成正比。
+    端点被其他位点删除的键会被丢弃。
+    """
+
+    def __init__(self, template) -> None:
+        self.template = template
+        self.sites = []
+
+    def add_site(self, site_name, options):
+        """
+        `options`为`[(标签, SiteDiff)]`
+        """
+        self.sites.append((site_name, list(options)))
+
+    def __len__(self) -> int:
+        return int(np.prod([len(options) for _, options in self.sites]))
+
+    def assemble(self, diffs):
+        template = self.template.molecule
+        elements, class_names, positions = template.elements, template.class_names, template.positions
+        removed = np.zeros(len(template), dtype=bool)
+        bonds_kept = np.ones(len(template.bonds), dtype=bool)
+        if any(len(diff.modified_rows) != 0 for diff in diffs):
+            elements, class_names, positions = elements.copy(), class_names.copy(), positions.copy()
+        for diff in diffs:
+            removed[diff.removed_rows] = True
+            bonds_kept[diff.removed_bonds] = False
+            for row, atom in zip(diff.modified_rows, diff.modified_atoms):
+                elements[row], class_names[row], positions[row] = atom.element, atom.class_name, atom.position
+        kept = np.flatnonzero(~removed)
+        remap = np.full(len(template), -1, dtype="int64")
+        remap[kept] = np.arange(len(kept))
+        ids, atom_elements, atom_class_names, atom_positions = [template.ids[kept]], [elements[kept]], [class_names[kept]], [positions[kept]]
+        bonds, bond_orders = [remap[template.bonds[bonds_kept]]], [template.bond_orders[bonds_kept]]
+        offset = len(kept)
+        for diff in diffs:
+            fragment = diff.fragment
+            ids.append(fragment.ids)
+            atom_elements.append(fragment.elements)
+            atom_class_names.append(fragment.class_names)
+            atom_positions.append(fragment.positions)
+            bonds += [fragment.bonds + offset, np.stack([remap[diff.links[:, 0]], diff.links[:, 1] + offset], axis=1), remap[diff.template_bonds]]
+            bond_orders += [fragment.bond_orders, diff.link_orders, diff.template_bond_orders]
+            offset += len(fragment)
+        bonds, bond_orders = np.concatenate(bonds), np.concatenate(bond_orders)
+        existed = (bonds >= 0).all(axis=1)
+        return Molecule(
+            np.concatenate(ids), np.concatenate(atom_elements), np.concatenate(atom_class_names),
+            np.concatenate(atom_positions), bonds[existed], bond_orders[existed],
+        )
+
+    def __iter__(self):
+        """
+        逐个产生`(StaticLayer, {位点名: 标签})`, 第一个位点变化最慢
+        """
+        site_names = [site_name for site_name, _ in self.sites]
+        for combination in product(*[options for _, options in self.sites]):
+            tags = {site_name: tag for site_name, (tag, _) in zip(site_names, combination)}
+            yield StaticLayer.from_molecule(self.assemble([diff for _, diff in combination])), tags
@@ -1,4 +1,5 @@
 from copy import deepcopy
+from types import MappingProxyType
 import uuid
 import numpy as np
 from pydash import py_
@@ -6,13 +7,23 @@ import json
 from libs.StateContainer import StateContainer
 from libs.UUIDPair import UUIDPair
 from libs.atoms_bonds_loader import atoms_bonds_loader
+from libs.layer_file import read_layer_file, write_layer_file
 from libs.constants import EPS
+from libs.Molecule import Molecule, new_ids
+from libs.PersistentMap import PersistentMap
+from libs.AtomIndex import AtomIndex
+from libs.Adjacency import Adjacency
 from libs.matrix import rotate_matrix
-from libs.molecule_text import atoms_bonds_from_mol2, mol2_to_atom, mol2_to_bond, molecule_text
+from libs.molecule_text import molecule_from_mol2, molecule_text
 from layers.StaticLayer import StaticLayer
+from layers.UtilLayers import MoleculeTransformer
 import re
 
-class DiffLayer:
+# keys possibly changed by selection updates: only the selection, which is compared as a whole
+SELECTION_KEYS = ((), (), None)
+
+
+class DiffLayer(MoleculeTransformer):
     def __init__(self, atoms, bonds) -> None:
         self.__atoms = deepcopy(atoms)
         self.__bonds = deepcopy(bonds)
@@ -31,57 +42,90 @@ class DiffLayer:
 class EditableLayer(StateContainer):
     @staticmethod
     def from_mol2(text):
-        editable = EditableLayer()
-        atoms_lines, bonds_lines = atoms_bonds_from_mol2(text)
-        atoms = py_.map(atoms_lines, mol2_to_atom)
-        atoms_ids = py_.map(atoms, lambda atom: atom[0])
-        atom_uuid_list = editable.add_atoms(py_.map(atoms, lambda atom: atom[1]))
-        atom_uuids = {
-            atom_id: atom_uuid for (atom_id, atom_uuid) in zip(atoms_ids, atom_uuid_list)
-        }
-        bonds = py_.map(bonds_lines, mol2_to_bond)
-        for (a, b, order) in bonds:
-            uuid_a, uuid_b = atom_uuids[a], atom_uuids[b]
-            editable.set_bond(uuid_a, uuid_b, order)
+        """
+        以mol2中的分子作为基础层, 返回没有修改的EditableLayer
+        """
+        return EditableLayer(StaticLayer.from_molecule(molecule_from_mol2(text)))
 
-        return editable
-        
     def __init__(self, base=StaticLayer(), load=None) -> None:
+        self.__views = {}
+        self.__views_version = None
+        self.__views_base = None
+        self.__index = None
+        self.__index_key = (None, None)
+        self.__adjacency = None
+        self.__adjacency_key = (None, None)
         if load is not None:
             if load["type"] != "editable":
                 raise ValueError("Not a EditableLayer dict")
             atoms, bonds = atoms_bonds_loader(load["atoms"], load["bonds"])
-            super().__init__((atoms, bonds, set()))
+            super().__init__((PersistentMap(atoms), PersistentMap(bonds), frozenset()), persistent=True)
             self.base = StaticLayer(load=load["base"])
         else:
-            super().__init__((dict(), dict(), set()))
+            super().__init__((PersistentMap(), PersistentMap(), frozenset()), persistent=True)
             self.base = base
 
+    def __getstate__(self):
+        # merged views are rebuilt on demand, the state and the base are enough
+        state = self.__dict__.copy()
+        state["_EditableLayer__views"] = {}
+        state["_EditableLayer__views_version"] = None
+        state["_EditableLayer__views_base"] = None
+        state["_EditableLayer__index"], state["_EditableLayer__index_key"] = None, (None, None)
+        state["_EditableLayer__adjacency"], state["_EditableLayer__adjacency_key"] = None, (None, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def snapshot(self):
+        """
+        返回与当前状态相同的EditableLayer, 之后对本层的修改不会影响它; 状态为持久化结构, 不需要复制
+        """
+        copied = EditableLayer(self.base)
+        state = self.state
+        copied.update(lambda _: state)
+        return copied
+
+    def __view(self, name, compute):
+        # merged views are cached until the state changes or the base is replaced
+        if self.__views_version != self.version or self.__views_base is not self.base:
+            self.__views = {}
+            self.__views_version = self.version
+            self.__views_base = self.base
+        if name not in self.__views:
+            self.__views[name] = compute()
+        return self.__views[name]
+
     @property
     def atoms(self):
-        overlayed = self.base.atoms | self.state[0]
-        existed = {
-            atom_id: overlayed[atom_id]
-            for atom_id in py_.filter(
-                overlayed.keys(), lambda atom_id: overlayed[atom_id] is not None
-            )
-        }
-        return existed
+        # the cached view is shared by all callers, so it is read-only; copy it with `dict` to modify
+        def compute():
+            overlayed = self.base.atoms | self.state[0]
+            return MappingProxyType({
+                atom_id: atom for atom_id, atom in overlayed.items() if atom is not None
+            })
+
+        return self.__view("atoms", compute)
 
     @property
     def bonds(self):
-        existed_atom_ids = self.atom_ids
-        overlayed = self.base.bonds | self.state[1]
-        existed = {
-            bond_id: overlayed[bond_id]
-            for bond_id in py_.filter(
-                overlayed.keys(),
-                lambda bond_id: bond_id.a in existed_atom_ids
+        def compute():
+            existed_atom_ids = self.atom_ids
+            overlayed = self.base.bonds | self.state[1]
+            return MappingProxyType({
+                bond_id: bond
+                for bond_id, bond in overlayed.items()
+                if bond is not None
+                and bond_id.a in existed_atom_ids
                 and bond_id.b in existed_atom_ids
-                and overlayed[bond_id] is not None,
-            )
-        }
-        return existed
+            })
+
+        return self.__view("bonds", compute)
+
+    @property
+    def molecule(self):
+        return self.__view("molecule", lambda: Molecule.from_atoms_bonds(self.atoms, self.bonds))
 
     @property
     def selected(self):
@@ -89,77 +133,166 @@ class EditableLayer(StateContainer):
 
     @property
     def atom_ids(self):
-        return set(self.atoms.keys())
+        return self.__view("atom_ids", lambda: frozenset(self.atoms.keys()))
 
     @property
     def bond_ids(self):
-        return set(self.bonds.keys())
+        return self.__view("bond_ids", lambda: frozenset(self.bonds.keys()))
+
+    def __current_atom(self, atoms_patch, atom_id):
+        if atom_id in atoms_patch:
+            return atoms_patch[atom_id]
+        return self.base.atoms.get(atom_id)
+
+    @property
+    def index(self):
+        # the index is an overlay on the base index, built from the atoms patch only
+        base, atoms_patch = self.__index_key
+        if base is not self.base or atoms_patch is not self.state[0]:
+            atoms_patch = self.state[0]
+            index = AtomIndex(self.base.index)
+            for atom_id, atom in atoms_patch.items():
+                index.replace(atom_id, self.base.atoms.get(atom_id), atom)
+            self.__index = index
+            self.__index_key = (self.base, atoms_patch)
+        return self.__index
+
+    @property
+    def adjacency(self):
+        # same as the index, an overlay on the base adjacency built from the bonds patch only
+        base, bonds_patch = self.__adjacency_key
+        if base is not self.base or bonds_patch is not self.state[1]:
+            bonds_patch = self.state[1]
+            adjacency = Adjacency(self.base.adjacency)
+            for bond_id, bond in bonds_patch.items():
+                adjacency.set(bond_id, bond)
+            self.__adjacency = adjacency
+            self.__adjacency_key = (self.base, bonds_patch)
+        return self.__adjacency
+
+    def __exists(self, atom_id):
+        return self.__current_atom(self.state[0], atom_id) is not None
+
+    def __atom(self, atom_id):
+        # look up a single atom without building the merged views, which are rebuilt after every update
+        atom = self.__current_atom(self.state[0], atom_id)
+        if atom is None:
+            raise KeyError(atom_id)
+        return atom
+
+    def batch(self):
+        """
+        批量修改: `with layer.batch(): ...`中的修改只在结束时校验并通知订阅者一次;
+        出错或校验失败(键的端点或选中的原子不存在)时恢复到开始前的状态, 不通知订阅者
+        """
+        return self.transaction(rollback=True, validate=self.__validate)
+
+    def __validate(self, delta):
+        atoms_patch, bonds_patch, selected = self.state
+        for bond_id in delta[1].keys:
+            if bonds_patch.get(bond_id) is not None and not (self.__exists(bond_id.a) and self.__exists(bond_id.b)):
+                raise KeyError("Bond between non-existed atoms.")
+        if not all(self.__exists(atom_id) for atom_id in selected):
+            raise KeyError("Some of selected atoms are not existed")
+
+    def neighbors(self, atom_id):
+        """
+        返回与`atom_id`成键的原子: {相邻原子ID: 键级}
+        """
+        if not self.__exists(atom_id):
+            raise KeyError("Atom not existed.")
+        return {
+            neighbor: bond
+            for neighbor, bond in self.adjacency.neighbors(atom_id).items()
+            if self.__exists(neighbor)
+        }
 
     def find_with_classname(self, class_name):
-        return py_.filter(self.atom_ids, lambda atom_id: class_name in self.atoms[atom_id].class_name.split(" "))
+        return self.index.with_class_name(class_name)
+
+    def find_with_element(self, element):
+        return self.index.with_element(element)
 
     def detach_diff_layer(self):
-        return DiffLayer(self.state[0], self.state[1])
+        return DiffLayer(dict(self.state[0].items()), dict(self.state[1].items()))
 
     def __patch_to_atoms(self, patch):
         def updator(state):
             a, b, s = state
             return a | patch, b, s
 
-        self.update(updator)
+        index, index_key = self.__index, self.__index_key
+        atoms_patch = self.state[0]
+        indexed = index_key[0] is self.base and index_key[1] is atoms_patch
+        if indexed:
+            previous = {atom_id: self.__current_atom(atoms_patch, atom_id) for atom_id in patch}
+        self.update(updator, (patch.keys(), (), ()))
+        # update the index incrementally if it was up to date before the patch
+        if indexed and self.__index_key is index_key:
+            for atom_id, atom in patch.items():
+                index.replace(atom_id, previous[atom_id], atom)
+            self.__index_key = (self.base, self.state[0])
 
     def __patch_to_bonds(self, patch):
         def updator(state):
             a, b, s = state
             return a, b | patch, s
 
-        self.update(updator)
-
-    def select(self, atom_ids):
+        adjacency, adjacency_key = self.__adjacency, self.__adjacency_key
+        bonds_patch = self.state[1]
+        self.update(updator, ((), patch.keys(), ()))
+        # update the adjacency incrementally if it was up to date before the patch
         if (
-            py_.chain(atom_ids)
-            .map(lambda atom_id: self.atoms.get(atom_id))
-            .every(lambda atom: atom is not None)
-            .value()
+            adjacency_key[0] is self.base
+            and adjacency_key[1] is bonds_patch
+            and self.__adjacency_key is adjacency_key
         ):
+            for bond_id, bond in patch.items():
+                adjacency.set(bond_id, bond)
+            self.__adjacency_key = (self.base, self.state[1])
+
+    def select(self, atom_ids):
+        atom_ids = frozenset(atom_ids)
+        if all(self.__exists(atom_id) for atom_id in atom_ids):
 
             def updator(state):
                 a, b, s = state
-                return a, b, (s | set(atom_ids))
+                return a, b, (s | atom_ids)
 
-            self.update(updator)
+            self.update(updator, SELECTION_KEYS)
             return 0
         raise KeyError("Some of atoms to select are not existed")
 
     def deselect(self, atom_ids):
         def updator(state):
             a, b, s = state
-            return a, b, set(py_.filter(s, lambda selected: selected not in atom_ids))
+            return a, b, s - frozenset(atom_ids)
 
-        self.update(updator)
+        self.update(updator, SELECTION_KEYS)
         return 0
 
     def deselect_all(self):
         def updator(state):
             a, b, _ = state
-            return a, b, set()
+            return a, b, frozenset()
 
-        self.update(updator)
+        self.update(updator, SELECTION_KEYS)
         return 0
 
     def select_all(self):
         def updator(state):
             a, b, s = state
-            return a, b, set(self.atom_ids)
+            return a, b, frozenset(self.atom_ids)
 
-        self.update(updator)
+        self.update(updator, SELECTION_KEYS)
         return 0
 
     def import_atoms_bonds(self, atoms, bonds):
-        self.deselect_all()
-        self.__patch_to_atoms(atoms)
-        self.__patch_to_bonds(bonds)
-        self.select(atoms.keys())
+        with self.batch():
+            self.deselect_all()
+            self.__patch_to_atoms(atoms)
+            self.__patch_to_bonds(bonds)
+            self.select(atoms.keys())
 
     def add_atoms(self, atoms):
         # to_add = {uuid(): atom for atom in atoms}
@@ -169,39 +302,39 @@ class EditableLayer(StateContainer):
         return py_.map(to_add, lambda id_atom: id_atom[0])
 
     def __remove_atoms(self, atom_ids):
-        if self.atom_ids.issuperset(atom_ids):
+        if all(self.__exists(atom_id) for atom_id in atom_ids):
             self.__patch_to_atoms({atom_id: None for atom_id in atom_ids})
             return 0
         raise KeyError("Non-existed id found.")
 
     def set_bond(self, atom_a_id, atom_b_id, bond):
-        atom_a, atom_b = self.atoms.get(atom_a_id), self.atoms.get(atom_b_id)
-        if None not in [atom_a, atom_b]:
+        if self.__exists(atom_a_id) and self.__exists(atom_b_id):
             self.__patch_to_bonds({UUIDPair((atom_a_id, atom_b_id)): bond})
             return 0
         raise KeyError("At least one of the atoms not existed.")
 
     def remove_selected(self):
-        self.__remove_atoms(self.selected)
-        bonds_remove = py_.filter(
-            self.bond_ids,
-            lambda atom_pair: atom_pair.a in self.selected
-            or atom_pair.b in self.selected,
-        )
-        self.__patch_to_bonds({bond_id: None for bond_id in bonds_remove})
-        self.deselect_all()
+        bonds_remove = {
+            UUIDPair((atom_id, neighbor))
+            for atom_id in self.selected
+            for neighbor in self.neighbors(atom_id)
+        }
+        with self.batch():
+            self.__remove_atoms(self.selected)
+            self.__patch_to_bonds({bond_id: None for bond_id in bonds_remove})
+            self.deselect_all()
         return 0
 
     def set_element_selected(self, element):
         updated = {
-            atom_id: self.atoms[atom_id].replace(element) for atom_id in self.selected
+            atom_id: self.__atom(atom_id).replace(element) for atom_id in self.selected
         }
         self.__patch_to_atoms(updated)
         return 0
 
     def translation_selected(self, vector):
         translated = {
-            atom_id: self.atoms[atom_id].move(vector) for atom_id in self.selected
+            atom_id: self.__atom(atom_id).move(vector) for atom_id in self.selected
         }
         self.__patch_to_atoms(translated)
         return 0
@@ -216,7 +349,7 @@ class EditableLayer(StateContainer):
         atom_ids = list(self.selected)
         rotated_atoms = (
             py_.chain(atom_ids)
-            .map(lambda atom_id: self.atoms[atom_id])
+            .map(self.__atom)
             .map(lambda atom: atom.move_to(calculate_target_position(atom.position)))
             .value()
         )
@@ -225,38 +358,61 @@ class EditableLayer(StateContainer):
         return 0
     
     def add_substitute(self, substitute, center_id, entry_id):
-        center = self.atoms[center_id]
-        entry = self.atoms[entry_id]
-        bond = self.bonds[UUIDPair((center_id, entry_id))]
+        """
+        用取代基替换`center_id`原子, 取代基的center原子放在被替换原子的位置, 并以原来的键级与`entry_id`成键
+        """
+        center = self.__atom(center_id)
+        entry = self.__atom(entry_id)
+        neighbors = self.neighbors(center_id)
+        bond = neighbors[entry_id]
         direction = center.position - entry.position
-        direction = direction / np.linalg.norm(direction)
-        atoms, bonds, center_idx, entry_idx = substitute.output(direction)
-        self.import_atoms_bonds(atoms, bonds)
-        new_center = self.atoms[center_idx]
-        to_move = center.position - new_center.position
-        self.translation_selected(to_move)
-        self.deselect_all()
-        self.select([center_id, entry_idx])
-        self.remove_selected()
-        self.set_bond(center_idx, entry_id, bond)
+        fragment, fragment_center = substitute.place(direction, center.position)
+        atoms, bonds = fragment.to_atoms_bonds()
+        with self.batch():
+            self.__patch_to_atoms(atoms | {center_id: None})
+            self.__patch_to_bonds(
+                bonds
+                | {UUIDPair((center_id, neighbor)): None for neighbor in neighbors}
+                | {UUIDPair((fragment.ids[fragment_center], entry_id)): bond}
+            )
+            self.deselect_all()
 
     def __repr__(self):
         return molecule_text(self)
 
     @property
     def export(self):
+        return {
+            "type": "editable",
+            **self.__export_patch(),
+            "base": self.base.export,
+        }
+
+    def __export_patch(self):
         atoms, bonds, _ = self.state
         atoms = {
             str(atom_id): atoms[atom_id].export if atoms[atom_id] is not None else None
             for atom_id in atoms.keys()
         }
         bonds = {bond_id.export: bonds[bond_id] for bond_id in bonds.keys()}
-        return {
-            "type": "editable",
-            "atoms": atoms,
-            "bonds": bonds,
-            "base": self.base.export,
-        }
+        return {"atoms": atoms, "bonds": bonds}
+
+    @staticmethod
+    def from_file(path):
+        """
+        打开`to_file`保存的层文件, 基础层同`StaticLayer.from_file`, 修改在打开时读取; 选择不会被保存
+        """
+        molecule, contains, patch = read_layer_file(path)
+        layer = EditableLayer(StaticLayer.from_molecule(molecule, contains))
+        if patch is not None:
+            patch = patch()
+            atoms, bonds = atoms_bonds_loader(patch["atoms"], patch["bonds"])
+            layer.update(lambda _: (PersistentMap(atoms), PersistentMap(bonds), frozenset()))
+        return layer
+
+    def to_file(self, path):
+        # the base is saved as fixed-width arrays, the patch is usually small and saved as JSON
+        write_layer_file(path, self.base.molecule, self.base.contains, self.__export_patch())
 
     def to_static_layer(self):
         from layers.StaticLayer import StaticLayer
@@ -266,7 +422,7 @@ substitute_re = re.compile("Substitute\(entry=(?P<entry>.*),center=(?P<center>.*
 class Substitute(StaticLayer):
     @staticmethod
     def from_mol2(text: str):
-        layer = EditableLayer.from_mol2(text)
+        layer = StaticLayer.from_molecule(molecule_from_mol2(text))
         entry_name, center_name = substitute_re.search(text).groups()
         entry_idx = layer.find_with_classname(entry_name)[0]
         center_idx = layer.find_with_classname(center_name)[0]
@@ -284,28 +440,18 @@ class Substitute(StaticLayer):
         self._entry_idx = entry_idx
         self._center_idx = center_idx
         self.eps = eps
-
-    def output(self, direction):
-        updated_atom_ids = {
-            origin_id: uuid.uuid4() for origin_id in self.atom_ids
-        }
-
-        updated_atoms_table = {
-            updated_atom_ids[origin_id]: self.atoms[origin_id] for origin_id in self.atom_ids
-        }
-
-        updated_bond_ids = {
-            uuid_pair: UUIDPair(tuple(py_.map(uuid_pair, lambda origin_uuid: updated_atom_ids[origin_uuid]))) for uuid_pair in self.bond_ids
-        }
-
-        updated_bonds_table = {
-            updated_bond_ids[origin_uuid_pair]: self.bonds[origin_uuid_pair] for origin_uuid_pair in self.bond_ids
-        }
-
-        updated_center_idx = updated_atom_ids[self._center_idx]
-        updated_entry_idx = updated_atom_ids[self._entry_idx]
-
-        direction = np.array(direction) / np.linalg.norm(direction)
+        # the substitute without its entry atom, which is placed by `place`
+        molecule = self.molecule
+        self._entry_row = molecule.index[entry_idx]
+        self._center_row = molecule.index[center_idx]
+        self._fragment = molecule.take(np.arange(len(molecule)) != self._entry_row)
+        self._fragment_center = self._center_row - (1 if self._center_row > self._entry_row else 0)
+
+    def alignment(self, direction):
+        """
+        将`_vector`(entry→center)转到`direction`的旋转矩阵, 作用方式为`positions @ matrix`
+        """
+        direction = np.array(direction, dtype="float64") / np.linalg.norm(direction)
         axis = np.cross(direction, self._vector)
         if(np.linalg.norm(axis) == 0.):
             [x, y, z] = direction
@@ -315,12 +461,34 @@ class Substitute(StaticLayer):
                 axis = np.array([y, -x, 0], dtype="float64")
         else:
             axis = axis/np.linalg.norm(axis)
-        angle = np.arccos(np.dot(self._vector, direction)) / (2*np.pi) * 360
-        editable_layer = EditableLayer()
-        editable_layer.import_atoms_bonds(updated_atoms_table, updated_bonds_table)
-        editable_layer.select_all()
-        editable_layer.rotation_selected(axis, editable_layer.atoms[updated_entry_idx].position, angle)
-        return editable_layer.atoms, editable_layer.bonds, updated_center_idx, updated_entry_idx
+        angle = np.arccos(np.clip(np.dot(self._vector, direction), -1., 1.)) / (2*np.pi) * 360
+        return rotate_matrix(axis, angle)
+
+    def place(self, direction, position):
+        """
+        返回放置好的片段(不含entry原子, 原子ID为新生成的)与片段中center原子的行号
+        片段按`direction`取向, center原子位于`position`
+        """
+        fragment = self._fragment
+        positions = fragment.positions
+        positions = np.matmul(positions - positions[self._fragment_center], self.alignment(direction)) + position
+        placed = Molecule(
+            new_ids(len(fragment)), fragment.elements, fragment.class_names,
+            positions, fragment.bonds, fragment.bond_orders,
+        )
+        return placed, self._fragment_center
+
+    def output(self, direction):
+        molecule = self.molecule
+        positions = molecule.positions
+        entry = positions[self._entry_row]
+        rotated = Molecule(
+            new_ids(len(molecule)), molecule.elements, molecule.class_names,
+            np.matmul(positions - entry, self.alignment(direction)) + entry,
+            molecule.bonds, molecule.bond_orders,
+        )
+        atoms, bonds = rotated.to_atoms_bonds()
+        return atoms, bonds, rotated.ids[self._center_row], rotated.ids[self._entry_row]
 
 if __name__ == "__main__":
     from libs.Atom import Atom
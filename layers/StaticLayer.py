@@ -1,14 +1,51 @@
 from copy import deepcopy
+from types import MappingProxyType
 from libs.atoms_bonds_loader import atoms_bonds_loader
 from libs.constants import PRODUCTION
 from libs.molecule_text import molecule_text
+from libs.Molecule import Molecule
+from libs.layer_file import ContainsLoader, read_layer_file, write_layer_file
+from libs.AtomIndex import AtomIndex
+from libs.Adjacency import Adjacency
 from layers.SymmetryLayers import SymmetryLayer
-from layers.UtilLayers import DedupLayer
+from layers.UtilLayers import AutoBondLayer, DedupLayer
 from pydash import py_
 
 
 class StaticLayer:
+    @staticmethod
+    def from_molecule(molecule, contains=None):
+        # per-atom objects are created only when `atoms` or `bonds` is used
+        layer = StaticLayer()
+        layer.__atoms, layer.__bonds = None, None
+        layer.__contains = contains
+        layer.__molecule = molecule
+        return layer
+
+    @staticmethod
+    def from_file(path):
+        """
+        打开`to_file`保存的二进制层文件, 坐标与键映射到文件内容, `contains`在第一次访问时读取
+        """
+        molecule, contains, patch = read_layer_file(path)
+        if patch is not None:
+            raise ValueError(f"{path} is saved from an EditableLayer, open it with EditableLayer.from_file")
+        return StaticLayer.from_molecule(molecule, contains)
+
+    def to_file(self, path):
+        write_layer_file(path, self.molecule, self.__own_contains())
+
     def __init__(self, atoms=dict(), bonds=dict(), contains=None, load=None) -> None:
+        """
+        `contains=(editable, transformers)`时只记录变换流程, 结构在第一次读取时才计算,
+        `contains`记录在第一次导出时才生成; 可修改的`editable`会先保存一份快照
+        """
+        self.__molecule = None
+        self.__pending = None
+        self.__existed_atoms = None
+        self.__existed_bonds = None
+        self.__index = None
+        self.__adjacency = None
         if load is not None:
             if load["type"] != "static":
                 raise ValueError("Not a StaticLayer dict")
@@ -19,48 +56,122 @@ class StaticLayer:
             return None
         if contains is not None:
             (editable, transfomers) = contains
+            snapshot = editable.snapshot() if hasattr(editable, "snapshot") else editable
+            self.__pending = (snapshot, list(transfomers))
+            self.__contains = None
+            atoms, bonds = None, None
+        else:
+            self.__contains = None
+        self.__atoms = atoms
+        self.__bonds = bonds
+
+    def __release(self):
+        # the recorded pipeline is dropped once both the structure and the history are built
+        if self.__molecule is not None and self.__contains is not None:
+            self.__pending = None
+
+    def __getstate__(self):
+        # send the columnar molecule instead of per-atom objects, caches are rebuilt on demand;
+        # an unbuilt `contains` is sent as the recorded pipeline, and built only when it is read
+        state = self.__dict__.copy()
+        state["_StaticLayer__molecule"] = self.molecule
+        state["_StaticLayer__pending"] = self.__pending
+        for cache in ["atoms", "bonds", "existed_atoms", "existed_bonds", "index", "adjacency"]:
+            state[f"_StaticLayer__{cache}"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __own_contains(self):
+        if isinstance(self.__contains, ContainsLoader):
+            self.__contains = self.__contains()
+        if self.__contains is None and self.__pending is not None:
+            editable, transformers = self.__pending
             self.__contains = {
                 "editable": editable.export,
                 "transformers": py_.map(
-                    transfomers, lambda transformer: transformer.export
+                    transformers, lambda transformer: transformer.export
                 ),
             }
-            atoms, bonds = editable.atoms, editable.bonds
-            for transformer in transfomers:
-                atoms, bonds = transformer(atoms, bonds)
-        else:
-            self.__contains = None
-        self.__atoms = atoms
-        self.__bonds = bonds
+            self.__release()
+        return self.__contains
 
     @property
     def contains(self):
         if PRODUCTION:
-            return self.__contains
+            return self.__own_contains()
         else:
-            return deepcopy(self.__contains)
+            return deepcopy(self.__own_contains())
+
+    def __atoms_bonds(self):
+        if self.__atoms is None:
+            self.__atoms, self.__bonds = self.molecule.to_atoms_bonds()
+        return self.__atoms, self.__bonds
 
     @property
     def atoms(self):
-        return {
-            atom_id: self.__atoms[atom_id]
-            for atom_id in py_.filter(
-                self.__atoms.keys(), lambda atom_id: self.__atoms[atom_id] is not None
-            )
-        }
+        # a StaticLayer never changes, the filtered views are computed only once and shared read-only
+        if self.__existed_atoms is None:
+            atoms, _ = self.__atoms_bonds()
+            self.__existed_atoms = MappingProxyType({
+                atom_id: atom for atom_id, atom in atoms.items() if atom is not None
+            })
+        return self.__existed_atoms
 
     @property
     def bonds(self):
-        existed_atoms = self.atom_ids
-        return {
-            bond_id: self.__bonds[bond_id]
-            for bond_id in py_.filter(
-                self.__bonds.keys(),
-                lambda bond_id: bond_id.a in existed_atoms
+        if self.__existed_bonds is None:
+            existed_atoms = self.atoms
+            _, bonds = self.__atoms_bonds()
+            self.__existed_bonds = MappingProxyType({
+                bond_id: bond
+                for bond_id, bond in bonds.items()
+                if bond is not None
+                and bond_id.a in existed_atoms
                 and bond_id.b in existed_atoms
-                and self.__bonds[bond_id] is not None,
-            )
-        }
+            })
+        return self.__existed_bonds
+
+    @property
+    def molecule(self):
+        if self.__molecule is None:
+            if self.__pending is not None:
+                editable, transformers = self.__pending
+                molecule = editable.molecule
+                for transformer in transformers:
+                    molecule = transformer.transform(molecule)
+                self.__molecule = molecule
+                self.__release()
+            else:
+                self.__molecule = Molecule.from_atoms_bonds(self.__atoms, self.__bonds)
+        return self.__molecule
+
+    @property
+    def index(self):
+        if self.__index is None:
+            self.__index = AtomIndex.from_atoms(self.atoms)
+        return self.__index
+
+    def find_with_classname(self, class_name):
+        return self.index.with_class_name(class_name)
+
+    def find_with_element(self, element):
+        return self.index.with_element(element)
+
+    @property
+    def adjacency(self):
+        if self.__adjacency is None:
+            self.__adjacency = Adjacency.from_bonds(self.bonds)
+        return self.__adjacency
+
+    def neighbors(self, atom_id):
+        """
+        返回与`atom_id`成键的原子: {相邻原子ID: 键级}
+        """
+        if atom_id not in self.atoms:
+            raise KeyError("Atom not existed.")
+        return dict(self.adjacency.neighbors(atom_id))
 
     @property
     def atom_ids(self):
@@ -86,7 +197,7 @@ class StaticLayer:
             "type": "static",
             "atoms": atoms,
             "bonds": bonds,
-            "contains": self.__contains,
+            "contains": self.__own_contains(),
         }
     
     @staticmethod
@@ -95,6 +206,8 @@ class StaticLayer:
             return SymmetryLayer.from_dict(data)
         if(data["type"] == "dedup"):
             return DedupLayer(data["eps"])
+        if(data["type"] == "autobond"):
+            return AutoBondLayer(data["radius_table"])
         raise ValueError("Invalid transformer inforamtion")
 
     def extract(self):
@@ -1,16 +1,17 @@
 import numpy as np
-from copy import deepcopy
 from pydash import py_
 from libs.molecule_text import molecule_text
-from libs.Atom import Atom, AtomWithId
-from libs.UUIDPair import UUIDPair
+from libs.Atom import Atom
+from libs.Molecule import Molecule, new_ids
 from libs.constants import EPS
-from libs.matrix import mirror_matrix, rotate_matrix
-from layers.UtilLayers import DedupLayer
-from uuid import uuid4 as uuid
+from libs.matrix import group_closure, mirror_matrix, rotate_matrix, schoenflies_generators
+from libs.DisjointSet import DisjointSet
+from libs.UUIDPair import UUIDPair
+from layers.UtilLayers import ChainStage, DedupLayer, IncrementalStage, MoleculeTransformer
+from scipy.spatial import cKDTree
 
 
-class SymmetryLayer:
+class SymmetryLayer(MoleculeTransformer):
     """
     对称层基类。
     """
@@ -18,41 +19,65 @@ class SymmetryLayer:
     def __init__(self) -> None:
         pass
 
-    def should_ignore_on_copy(self, atom):
+    def should_ignore_on_copy(self, positions):
         """
-        该函数用于在调用`copy_atoms`方法时判断是否需要对原子进行复制(即生成新的ID),对每个子类,应该手动实现该方法。
+        该函数用于在调用`expand`方法时判断哪些原子不需要复制(即保留原ID), 输入为(N,3)坐标数组, 返回(N,)布尔数组, 对每个子类,应该手动实现该方法。
         """
-        raise NotImplementedError("Must implemented before using default copy_atoms")
+        raise NotImplementedError("Must implemented before using default expand")
 
-    def copy_atoms(self, origin_atoms):
+    @property
+    def operators(self):
         """
-        调用该方法从原始原子数组中生成一份拷贝，如果该原子被`should_ignore_on_copy`返回为`True`,则使用Atom.copy(),否则使用deepcopy()
+        对称操作(不含恒等操作)的矩阵, 形状为(n,3,3), 坐标按`(position - center) @ matrix + center`变换, 子类应实现该属性
         """
-        return py_.map(
-            origin_atoms,
-            lambda atom: atom.copy()
-            if not self.should_ignore_on_copy(atom)
-            else deepcopy(atom),
-        )
+        raise NotImplementedError("Must implemented before using default transform")
 
-    def generate_bonds(self, origin_atoms, new_atoms, bonds):
+    def images(self, positions, operators=None):
         """
-        根据原始原子数组和键连接的情况，生成新的原子数组中原子的键连接情况
+        一次性计算所有对称操作作用后的坐标, 返回(n,N,3)数组
         """
-        origin_ids = py_.map(origin_atoms, lambda atom: atom.get_id())
-        new_ids = py_.map(new_atoms, lambda atom: atom.get_id())
-        id_refs = {}
-        for origin_id, new_ids in zip(origin_ids, new_ids):
-            id_refs[origin_id] = new_ids
+        operators = self.operators if operators is None else operators
+        return np.einsum("kj,njl->nkl", positions - self.center, operators) + self.center
+
+    def expand(self, molecule, operators=None):
+        """
+        将原始分子与所有对称操作的像合并。
+        被`should_ignore_on_copy`标记的原子不复制, 像中指向它们的键连接到原始原子上。
+        """
+        images = self.images(molecule.positions, operators)
+        n, m = len(molecule), len(images)
+        fixed = self.should_ignore_on_copy(molecule.positions)
+        moved = np.flatnonzero(~fixed)
+        k = len(moved)
+        if m == 0 or k == 0:
+            return molecule
+
+        refs = np.tile(np.arange(n), (m, 1))
+        refs[:, moved] = n + np.arange(m * k).reshape(m, k)
+        new_bonds = ~fixed[molecule.bonds].all(axis=1)
+        image_bonds = refs[:, molecule.bonds[new_bonds]].reshape(-1, 2)
+
+        return Molecule(
+            np.concatenate([molecule.ids, new_ids(m * k)]),
+            np.concatenate([molecule.elements, np.tile(molecule.elements[moved], m)]),
+            np.concatenate([molecule.class_names, np.tile(molecule.class_names[moved], m)]),
+            np.concatenate([molecule.positions, images[:, moved].reshape(-1, 3)]),
+            np.concatenate([molecule.bonds, image_bonds]),
+            np.concatenate([molecule.bond_orders, np.tile(molecule.bond_orders[new_bonds], m)]),
+        )
+
+    def transform(self, molecule):
+        return self.expand(molecule)
 
-        new_bonds = {}
-        for atom_pair in bonds.keys():
-            a, b = atom_pair.a, atom_pair.b
-            a, b = id_refs[a], id_refs[b]
-            new_pair = UUIDPair((a, b))
-            new_bonds[new_pair] = bonds[atom_pair]
+    def incremental(self):
+        return SymmetryStage(self, self.operators, self.should_ignore_on_copy)
 
-        return new_bonds
+    @property
+    def generator(self):
+        """
+        生成该对称元素全部操作的单个矩阵, 用于`PointGroupLayer`求群的闭包
+        """
+        raise NotImplementedError("Should implement in sub-class")
 
     @property
     def export(self):
@@ -68,6 +93,8 @@ class SymmetryLayer:
             return MirrorLayer(data["law_vector"], center, eps)
         if(data["type"] == "symmetry.rotation"):
             return RotationLayer(data["axis"], data["times"], data["mode"], center, eps)
+        if(data["type"] == "symmetry.pointgroup"):
+            return PointGroupLayer(data["symbol"] if data["symbol"] is not None else data["operators"], center, eps)
         raise ValueError("Invalid input data")
 
 class InverseLayer(SymmetryLayer):
@@ -80,29 +107,24 @@ class InverseLayer(SymmetryLayer):
         self.eps = eps
         self.center = np.array(center, dtype="float64")
 
-    def on_center(self, position):
-        return np.linalg.norm(position - self.center) < self.eps
+    def on_center(self, positions):
+        return np.linalg.norm(positions - self.center, axis=-1) < self.eps
 
-    def should_ignore_on_copy(self, atom):
-        return self.on_center(atom.position)
+    def should_ignore_on_copy(self, positions):
+        return self.on_center(positions)
 
     def inverse(self, positions):
         centered = positions - self.center
         inversed = -1 * centered
         return inversed + self.center
 
-    def __call__(self, atoms, bonds):
-        atoms = AtomWithId.from_atoms(atoms)
-        inversed_positions = self.inverse(py_.map(atoms, lambda atom: atom.position))
-        inversed = (
-            py_.chain(zip(self.copy_atoms(atoms), inversed_positions))
-            .map(lambda ap: ap[0].move_to(ap[1]))
-            .value()
-        )
-        atoms = py_.uniq_by(atoms + inversed, lambda atom: atom.get_id())
-        bonds = bonds | self.generate_bonds(atoms, inversed, bonds)
-        atoms = AtomWithId.to_atoms_dict(atoms)
-        return atoms, bonds
+    @property
+    def generator(self):
+        return -1.0 * np.eye(3)
+
+    @property
+    def operators(self):
+        return self.generator[None]
 
     @property
     def export(self):
@@ -118,30 +140,25 @@ class MirrorLayer(SymmetryLayer):
         self.center = np.array(center, dtype="float64")
         self.eps = eps
 
-    def on_mirror(self, position):
-        OP = position - self.center
-        return abs(np.dot(OP, self.law_vector)) < self.eps
+    def on_mirror(self, positions):
+        OP = positions - self.center
+        return np.abs(np.dot(OP, self.law_vector)) < self.eps
 
     def mirror(self, positions):
         positions = positions - self.center
         targets = np.matmul(positions, self.matrix)
         return targets + self.center
 
-    def should_ignore_on_copy(self, atom):
-        return self.on_mirror(atom.position)
+    def should_ignore_on_copy(self, positions):
+        return self.on_mirror(positions)
 
-    def __call__(self, atoms, bonds):
-        atoms = AtomWithId.from_atoms(atoms)
-        mirrored_positions = self.mirror(py_.map(atoms, lambda atom: atom.position))
-        mirrored = (
-            py_.chain(zip(self.copy_atoms(atoms), mirrored_positions))
-            .map(lambda ap: ap[0].move_to(ap[1]))
-            .value()
-        )
-        atoms = py_.uniq_by(atoms + mirrored, lambda atom: atom.get_id())
-        bonds = bonds | self.generate_bonds(atoms, mirrored, bonds)
-        atoms = AtomWithId.to_atoms_dict(atoms)
-        return atoms, bonds
+    @property
+    def generator(self):
+        return self.matrix
+
+    @property
+    def operators(self):
+        return self.matrix[None]
 
     @property
     def export(self):
@@ -189,42 +206,55 @@ class RotationLayer(SymmetryLayer):
         self.dedup = DedupLayer(self.eps) if mode in ["I", "S"] else None
 
     def rotate(self, positions):
+        """
+        绕经过`center`的轴变换坐标, `center`保持不动
+        """
         positions = positions - self.center
-        return np.matmul(positions, self.matrix)
+        return np.matmul(positions, self.matrix) + self.center
 
-    def on_axis(self, position):
-        OP = position - self.center
+    def on_axis(self, positions):
+        OP = positions - self.center
         # self.axis is a unit vector
-        delta = OP - np.dot(OP, self.axis) * self.axis
-        delta = np.linalg.norm(delta)
+        delta = OP - np.outer(np.dot(OP, self.axis), self.axis)
+        delta = np.linalg.norm(delta, axis=-1)
         return delta < self.eps
 
-    def on_center(self, position):
-        return np.linalg.norm(position - self.center) < self.eps
+    def on_center(self, positions):
+        return np.linalg.norm(positions - self.center, axis=-1) < self.eps
 
-    def should_ignore_on_copy(self, atom):
+    def should_ignore_on_copy(self, positions):
         if self.dedup is None:
-            return self.on_axis(atom.position)
-        return self.on_center(atom.position)
-
-    def __call__(self, atoms, bonds):
-        atoms = AtomWithId.from_atoms(atoms)
-        rotated_atoms = deepcopy(atoms)
-        rotated_bonds = deepcopy(bonds)
-        current_positions = py_.map(atoms, lambda atom: atom.position)
-        for _ in range(
-            1, self.times * (1 if self.dedup is None or self.times % 2 == 0 else 2)
-        ):
-            current_positions = self.rotate(current_positions)
-            new_atoms = self.copy_atoms(atoms)
-            atom_positions = zip(new_atoms, current_positions)
-            rotated_atoms += py_.map(atom_positions, lambda ap: ap[0].move_to(ap[1]))
-            rotated_bonds = rotated_bonds | self.generate_bonds(atoms, new_atoms, bonds)
-        rotated_atoms = py_.uniq_by(rotated_atoms, lambda atom: atom.get_id())
-        rotated_atoms = AtomWithId.to_atoms_dict(rotated_atoms)
+            return self.on_axis(positions)
+        return self.on_center(positions)
+
+    @property
+    def generator(self):
+        return self.matrix
+
+    @property
+    def operators(self):
+        """
+        操作矩阵的1至m-1次幂, 对奇数次的映轴和反轴m=2n, 否则m=n
+        """
+        order = self.times * (1 if self.dedup is None or self.times % 2 == 0 else 2)
+        powers = np.empty((max(order - 1, 0), 3, 3), dtype="float64")
+        current = np.eye(3)
+        for i in range(len(powers)):
+            current = np.matmul(current, self.matrix)
+            powers[i] = current
+        return powers
+
+    def transform(self, molecule):
+        rotated = self.expand(molecule)
+        if self.dedup is None:
+            return rotated
+        return self.dedup.transform(rotated)
+
+    def incremental(self):
+        stage = super().incremental()
         if self.dedup is None:
-            return rotated_atoms, rotated_bonds
-        return self.dedup(rotated_atoms, rotated_bonds)
+            return stage
+        return ChainStage([stage, self.dedup.incremental()])
 
     @property
     def export(self):
@@ -238,29 +268,214 @@ class RotationLayer(SymmetryLayer):
         }
 
 
-if __name__ == "__main__":
-    from EditableLayer import EditableLayer
-    from StaticLayer import StaticLayer
+class PointGroupLayer(SymmetryLayer):
+    """
+    点群层: 将多个对称元素(或Schoenflies符号)合成为闭合的点群, 一次性施加全部对称操作
 
-    symmetry = RotationLayer([0, 0, 1], 6, "S")
+    每个原子只与自身的像(轨道)去重, 因此生成的原子数恰为 原子数 x 群阶 / 稳定子群阶
+    """
+
+    def __init__(self, elements, center=None, eps=EPS) -> None:
+        """
+        初始化一个点群层
+        ---
+        parameters:
+
+        - elements: Schoenflies符号(如"D3h", 主轴为z轴, C2'为x轴), `SymmetryLayer`列表, 或(n,3,3)操作矩阵
+        - center: 点群中心, 使用对称元素列表时默认取各元素的共同中心, 否则默认为[0,0,0]
+        - eps: 容差范围, 用于判断矩阵是否相同以及原子的像是否重合, 默认值为1E-8
+        """
+        super().__init__()
+        self.eps = eps
+        self.symbol = elements if isinstance(elements, str) else None
+        if self.symbol is not None:
+            generators = schoenflies_generators(self.symbol)
+        elif len(elements) != 0 and isinstance(elements[0], SymmetryLayer):
+            centers = py_.map(elements, lambda element: element.center)
+            if center is None:
+                center = centers[0]
+            if not all(np.linalg.norm(item - center) < eps for item in centers):
+                raise ValueError("Symmetry elements of a point group must share the same center")
+            generators = py_.map(elements, lambda element: element.generator)
+        else:
+            generators = np.array(elements, dtype="float64").reshape(-1, 3, 3)
+        self.center = np.array(center if center is not None else [0.0, 0.0, 0.0], dtype="float64")
+        self.group = group_closure(generators, eps)
+
+    @property
+    def order(self):
+        return len(self.group)
 
-    output_layer = StaticLayer()
+    @property
+    def operators(self):
+        return self.group[1:]
+
+    def orbits(self, images):
+        """
+        对(g,N,3)的像坐标, 合并同一原子重合的像, 返回每个像的代表(展平后的下标, 单位操作的像排在最前)
+        """
+        g, n = images.shape[0:2]
+        flat = images.reshape(-1, 3)
+        pairs = cKDTree(flat).query_pairs(self.eps, output_type="ndarray")
+        pairs = pairs[pairs[:, 0] % n == pairs[:, 1] % n]
+        distances = np.linalg.norm(flat[pairs[:, 0]] - flat[pairs[:, 1]], axis=1)
+        orbits = DisjointSet(g * n)
+        orbits.union_pairs(pairs[distances < self.eps])
+        return orbits.roots()
+
+    def transform(self, molecule):
+        n = len(molecule)
+        if n == 0:
+            return molecule
+        images = self.images(molecule.positions, self.group)
+        representatives = self.orbits(images)
+        kept = representatives == np.arange(len(representatives))
+        rows = (np.cumsum(kept) - 1)[representatives].reshape(self.order, n)
+        generated = np.flatnonzero(kept[n:])
+        sources = generated % n
+
+        bonds = np.sort(rows[:, molecule.bonds].reshape(-1, 2), axis=1)
+        bond_orders = np.tile(molecule.bond_orders, self.order)
+        total = n + len(generated)
+        _, first = np.unique(bonds[:, 0] * total + bonds[:, 1], return_index=True)
+        first = np.sort(first[bonds[first, 0] != bonds[first, 1]])
+
+        return Molecule(
+            np.concatenate([molecule.ids, new_ids(len(generated))]),
+            np.concatenate([molecule.elements, molecule.elements[sources]]),
+            np.concatenate([molecule.class_names, molecule.class_names[sources]]),
+            np.concatenate([molecule.positions, images[1:].reshape(-1, 3)[generated]]),
+            bonds[first],
+            bond_orders[first],
+        )
 
-    def output(state):
-        global output_layer
-        a, b, _ = state
-        a, b = symmetry(a, b)
-        output_layer = StaticLayer(a, b)
-        # print(molecule_output(output_layer))
+    def incremental(self):
+        return SymmetryStage(self, self.operators)
+
+    @property
+    def export(self):
+        return {
+            "type": "symmetry.pointgroup",
+            "symbol": self.symbol,
+            "operators": self.group.tolist(),
+            "center": list(self.center),
+            "eps": self.eps,
+        }
+
+
+class SymmetryStage(IncrementalStage):
+    """
+    对称层的增量版本: 只重新计算被修改的原子的像, 以及与它们成键或被修改的键的像, 每个原子的像的ID在修改之间保持不变
+
+    `fixed`为`SymmetryLayer.should_ignore_on_copy`时不复制被标记的原子(同`expand`);
+    为`None`时与同一原子的已有的像重合的像不复制(同`PointGroupLayer`)
+    """
+
+    def __init__(self, layer, operators, fixed=None) -> None:
+        super().__init__()
+        self.layer = layer
+        self.operators = operators
+        self.fixed = fixed
+        self.image_ids = {}
+        # image id -> (operator, id of the original atom)
+        self.image_of = {}
+        self.refs = {}
+        self.bond_images = {}
+
+    def __refs(self, atom_id, atom, images, fixed):
+        """
+        原子在各对称操作下的像对应的输出原子ID, 并将新的像加入输出
+        """
+        if fixed:
+            return [atom_id] * len(images)
+        ids = self.image_ids.get(atom_id)
+        if ids is None:
+            ids = self.image_ids[atom_id] = new_ids(len(images))
+            for operator, image_id in enumerate(ids):
+                self.image_of[image_id] = (operator, atom_id)
+        refs, kept, positions = [], [atom_id], [atom.position]
+        for image_id, position in zip(ids, images):
+            if self.fixed is None:
+                distances = np.linalg.norm(np.array(positions) - position, axis=1)
+                if distances.min() < self.layer.eps:
+                    refs.append(kept[int(distances.argmin())])
+                    continue
+                kept.append(image_id)
+                positions.append(position)
+            self.atoms[image_id] = Atom(atom.element, position, atom.class_name)
+            refs.append(image_id)
+        return refs
+
+    def atom_key(self, atom_id):
+        # the originals come first, then the images ordered by the operator, same as the rows of full transforms
+        if atom_id in self.refs:
+            return (0, self.source.atom_key(atom_id))
+        operator, origin = self.image_of[atom_id]
+        return (operator + 1, self.source.atom_key(origin))
+
+    def update(self, source, atom_ids, bond_ids):
+        atoms, bonds = source.atoms, source.bonds
+        self.source = source
+        changed_atoms, changed_bonds = set(), set()
+        affected = self.affected_bonds(bonds, atom_ids, bond_ids)
+        for bond_id in affected:
+            for image, key in self.bond_images.pop(bond_id, ()):
+                self.unlink(image, key, changed_bonds)
+        existed = []
+        for atom_id in atom_ids:
+            changed_atoms.add(atom_id)
+            self.atoms.pop(atom_id, None)
+            for image_id in self.image_ids.get(atom_id, ()):
+                if self.atoms.pop(image_id, None) is not None:
+                    changed_atoms.add(image_id)
+            self.refs.pop(atom_id, None)
+            if atoms.get(atom_id) is not None:
+                existed.append(atom_id)
+            else:
+                for image_id in self.image_ids.pop(atom_id, ()):
+                    del self.image_of[image_id]
+        if len(existed) != 0:
+            positions = np.array([atoms.get(atom_id).position for atom_id in existed], dtype="float64")
+            images = self.layer.images(positions, self.operators)
+            fixed = self.fixed(positions) if self.fixed is not None else np.zeros(len(existed), dtype=bool)
+            for column, atom_id in enumerate(existed):
+                atom = atoms.get(atom_id)
+                self.atoms[atom_id] = atom
+                self.refs[atom_id] = self.__refs(atom_id, atom, images[:, column], fixed[column])
+                changed_atoms.update(self.refs[atom_id])
+
+        for bond_id in affected:
+            bond = IncrementalStage.bond_of(atoms, bonds, bond_id)
+            if bond is None:
+                continue
+            # ordered by the operator first, then the input bond, same as the rows of full transforms
+            key = source.bond_key(bond_id)
+            images = {bond_id: (0, key)}
+            for operator, (a, b) in enumerate(zip(self.refs[bond_id.a], self.refs[bond_id.b])):
+                image = UUIDPair((a, b))
+                if a != b and image not in images:
+                    images[image] = (operator + 1, key)
+            for image, image_key in images.items():
+                self.link(image, image_key, bond, changed_bonds)
+            self.bond_images[bond_id] = list(images.items())
+        return changed_atoms, changed_bonds
+
+
+if __name__ == "__main__":
+    from layers.EditableLayer import EditableLayer
+    from layers.UtilLayers import IncrementalPipeline
+
+    symmetry = RotationLayer([0, 0, 1], 6, "S")
 
+    # the symmetric structure is updated with each edit, only images of modified atoms are recalculated
     layer = EditableLayer()
-    layer.add_subscriber(output)
+    output = IncrementalPipeline(layer, [symmetry])
     [C, H] = layer.add_atoms([Atom("C", [0, 0, 1]), Atom("H", [1, 0, 1.2])])
     layer.set_bond(C, H, 1.0)
     layer.select([H])
     layer.set_element_selected("Cl")
 
-    layer = EditableLayer(output_layer)
+    layer = EditableLayer(output.to_static_layer())
     [C1, C2] = py_.filter(
         layer.atom_ids, lambda atom_id: layer.atoms[atom_id].element == "C"
     )
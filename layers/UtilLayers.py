@@ -1,111 +1,584 @@
-from pydash import py_
+from collections import ChainMap
 import numpy as np
-from copy import deepcopy
-from libs.Atom import AtomWithId
+from libs.Atom import Atom
+from libs.DisjointSet import DisjointSet
+from libs.SpatialGrid import SpatialGrid
 from libs.UUIDPair import UUIDPair
 from libs.RadiiTable import default_radius_table
 from libs.constants import EPS
+from libs.Molecule import Molecule, object_array
+from scipy.spatial import cKDTree
 
 
-class DedupLayer:
+class MoleculeTransformer:
+    """
+    变换层基类, 子类实现`transform`(Molecule -> Molecule)或`__call__`(atoms, bonds -> atoms, bonds)之一即可
+    """
+
+    def transform(self, molecule):
+        atoms, bonds = self(*molecule.to_atoms_bonds())
+        return Molecule.from_atoms_bonds(atoms, bonds)
+
+    def __call__(self, atoms, bonds):
+        return self.transform(Molecule.from_atoms_bonds(atoms, bonds)).to_atoms_bonds()
+
+    def incremental(self):
+        """
+        返回该层的增量版本(`IncrementalStage`), 默认每次修改后对整个结构重新变换
+        """
+        return FullStage(self)
+
+
+class IncrementalStage:
+    """
+    变换层的增量版本, 保存上一次的输出`atoms`, `bonds`, 每次只重新计算受修改影响的原子与键
+
+    `update(source, atom_ids, bond_ids)`: `source`为变换前的结构(`EditableSource`或上一个stage), 其`atoms`/`bonds`只需支持`get`
+    (值为`None`表示不存在, 端点不存在的键也视为不存在), `atom_key`/`bond_key`给出原子与键在全量变换中的先后顺序;
+    atom_ids/bond_ids为被修改的原子与键, 返回输出中被修改的(原子ID, 键ID)。
+    stage同样提供输出的`atom_key`/`bond_key`, 作为下一个stage的`source`
+    """
+
+    def __init__(self) -> None:
+        self.atoms = {}
+        self.bonds = {}
+        self.source = None
+        # neighbors of input atoms, to find bonds affected by modified atoms
+        self.neighbors = {}
+        # output bond -> {key: bond} of the input bonds generating it
+        self.bond_sources = {}
+
+    @staticmethod
+    def bond_of(atoms, bonds, bond_id):
+        bond = bonds.get(bond_id)
+        if bond is None or atoms.get(bond_id.a) is None or atoms.get(bond_id.b) is None:
+            return None
+        return bond
+
+    def affected_bonds(self, bonds, atom_ids, bond_ids):
+        """
+        记录输入的键的修改, 返回被修改的键与被修改原子上的键
+        """
+        for bond_id in bond_ids:
+            a, b = bond_id.a, bond_id.b
+            if bonds.get(bond_id) is None:
+                self.neighbors.get(a, set()).discard(b)
+                self.neighbors.get(b, set()).discard(a)
+            else:
+                self.neighbors.setdefault(a, set()).add(b)
+                self.neighbors.setdefault(b, set()).add(a)
+        affected = set(bond_ids)
+        for atom_id in atom_ids:
+            for neighbor in self.neighbors.get(atom_id, ()):
+                affected.add(UUIDPair((atom_id, neighbor)))
+        return affected
+
+    def link(self, bond_id, key, bond, changed):
+        """
+        输出的键可以由多个输入的键生成, 与全量变换相同, 取`key`(在全量变换中的顺序)最小的键的键级
+        """
+        sources = self.bond_sources.setdefault(bond_id, {})
+        sources[key] = bond
+        self.bonds[bond_id] = sources[min(sources)]
+        changed.add(bond_id)
+
+    def unlink(self, bond_id, key, changed):
+        sources = self.bond_sources[bond_id]
+        del sources[key]
+        if len(sources) == 0:
+            del self.bond_sources[bond_id]
+            del self.bonds[bond_id]
+        else:
+            self.bonds[bond_id] = sources[min(sources)]
+        changed.add(bond_id)
+
+    def atom_key(self, atom_id):
+        raise NotImplementedError("Should implement in sub-class")
+
+    def bond_key(self, bond_id):
+        return min(self.bond_sources[bond_id])
+
+    def update(self, source, atom_ids, bond_ids):
+        raise NotImplementedError("Should implement in sub-class")
+
+
+class EditableSource:
+    """
+    `EditableLayer`的一个状态, 作为第一个stage的`source`
+
+    原子与键的顺序与`EditableLayer.atoms`/`bonds`相同: 先是基础层中的(按基础层中的顺序), 再是只在修改中的(按加入的顺序)
+    """
+
+    def __init__(self, base, base_bond_rows, state) -> None:
+        atoms_patch, bonds_patch, _ = state
+        self.base = base
+        self.base_bond_rows = base_bond_rows
+        self.atoms_patch = atoms_patch
+        self.bonds_patch = bonds_patch
+        self.atoms = ChainMap(atoms_patch, base.atoms)
+        self.bonds = ChainMap(bonds_patch, base.bonds)
+
+    def atom_key(self, atom_id):
+        row = self.base.molecule.index.get(atom_id)
+        return (0, row) if row is not None else (1, self.atoms_patch.position(atom_id))
+
+    def bond_key(self, bond_id):
+        row = self.base_bond_rows.get(bond_id)
+        return (0, row) if row is not None else (1, self.bonds_patch.position(bond_id))
+
+
+class FullStage(IncrementalStage):
+    """
+    没有增量实现的变换层: 每次修改后重新变换整个结构
+    """
+
+    def __init__(self, transformer) -> None:
+        super().__init__()
+        self.transformer = transformer
+        self.inputs = ({}, {})
+        self.atom_rows = {}
+        self.bond_rows = {}
+
+    def update(self, source, atom_ids, bond_ids):
+        inputs_atoms, inputs_bonds = self.inputs
+        inputs_atoms = dict(inputs_atoms)
+        inputs_bonds = dict(inputs_bonds)
+        for atom_id in atom_ids:
+            inputs_atoms[atom_id] = source.atoms.get(atom_id)
+        for bond_id in bond_ids:
+            inputs_bonds[bond_id] = source.bonds.get(bond_id)
+        # in the order of the source, same as the rows of the full transform
+        inputs_atoms = dict(sorted(
+            ((atom_id, atom) for atom_id, atom in inputs_atoms.items() if atom is not None),
+            key=lambda item: source.atom_key(item[0]),
+        ))
+        inputs_bonds = {bond_id: bond for bond_id, bond in inputs_bonds.items() if bond is not None}
+        self.inputs = (inputs_atoms, inputs_bonds)
+        existed_bonds = dict(sorted(
+            (
+                (bond_id, bond) for bond_id, bond in inputs_bonds.items()
+                if IncrementalStage.bond_of(inputs_atoms, inputs_bonds, bond_id) is not None
+            ),
+            key=lambda item: source.bond_key(item[0]),
+        ))
+        previous_atoms, previous_bonds = self.atoms, self.bonds
+        self.atoms, self.bonds = self.transformer(inputs_atoms, existed_bonds)
+        self.atom_rows = {atom_id: row for row, atom_id in enumerate(self.atoms)}
+        self.bond_rows = {bond_id: row for row, bond_id in enumerate(self.bonds)}
+        return set(previous_atoms) | set(self.atoms), set(previous_bonds) | set(self.bonds)
+
+    def atom_key(self, atom_id):
+        return self.atom_rows[atom_id]
+
+    def bond_key(self, bond_id):
+        return self.bond_rows[bond_id]
+
+
+class ChainStage(IncrementalStage):
+    """
+    依次执行多个`IncrementalStage`
+    """
+
+    def __init__(self, stages) -> None:
+        super().__init__()
+        self.stages = list(stages)
+
+    def update(self, source, atom_ids, bond_ids):
+        for stage in self.stages:
+            atom_ids, bond_ids = stage.update(source, atom_ids, bond_ids)
+            source = stage
+        self.atoms, self.bonds = source.atoms, source.bonds
+        return atom_ids, bond_ids
+
+    def atom_key(self, atom_id):
+        return self.stages[-1].atom_key(atom_id)
+
+    def bond_key(self, bond_id):
+        return self.stages[-1].bond_key(bond_id)
+
+
+class IncrementalPipeline:
+    """
+    订阅`EditableLayer`, 由其每次修改的原子与键只更新变换结果中受影响的部分
+
+    结果`atoms`, `bonds`与`StaticLayer(contains=(editable, transformers))`相同(新生成原子的ID除外),
+    同一原子的像在修改之间保持相同的ID。基础层被替换时重新计算全部结果。
+    """
+
+    def __init__(self, editable, transformers) -> None:
+        self.editable = editable
+        self.transformers = list(transformers)
+        self.refresh()
+        editable.add_subscriber(self, incremental=True)
+
+    def refresh(self):
+        self.stages = [transformer.incremental() for transformer in self.transformers]
+        self.base = self.editable.base
+        self.base_bond_rows = {bond_id: row for row, bond_id in enumerate(self.base.bonds)}
+        self.__run(self.editable.state, self.editable.atom_ids, self.editable.bond_ids)
+
+    def __run(self, state, atom_ids, bond_ids):
+        source = EditableSource(self.base, self.base_bond_rows, state)
+        for stage in self.stages:
+            atom_ids, bond_ids = stage.update(source, atom_ids, bond_ids)
+            source = stage
+        return atom_ids, bond_ids
+
+    def __call__(self, state, delta):
+        if self.base is not self.editable.base:
+            self.refresh()
+            return
+        atom_ids, bond_ids = delta[0].keys, delta[1].keys
+        if len(atom_ids) == 0 and len(bond_ids) == 0:
+            return
+        self.__run(state, atom_ids, bond_ids)
+
+    def close(self):
+        self.editable.remove_subscriber(self)
+
+    @property
+    def atoms(self):
+        return self.stages[-1].atoms if len(self.stages) != 0 else self.editable.atoms
+
+    @property
+    def bonds(self):
+        return self.stages[-1].bonds if len(self.stages) != 0 else self.editable.bonds
+
+    @property
+    def molecule(self):
+        return Molecule.from_atoms_bonds(self.atoms, self.bonds)
+
+    def to_static_layer(self):
+        from layers.StaticLayer import StaticLayer
+        return StaticLayer(dict(self.atoms), dict(self.bonds))
+
+
+class DedupLayer(MoleculeTransformer):
+    """
+    合并元素相同且距离小于eps的原子, 每组保留行号最小的原子, 被合并原子的键连接到保留的原子上
+    """
+
     def __init__(self, eps=EPS) -> None:
         self.eps = eps
 
-    def __call__(self, atoms, bonds):
-        atoms = AtomWithId.from_atoms(atoms)
-
-        def find_dups(atom):
-            dups = (
-                py_.chain(atoms)
-                .filter(
-                    lambda target: target.element == atom.element
-                    and np.linalg.norm(target.position - atom.position) < self.eps
-                )
-                .map(lambda target: UUIDPair((target.get_id(), atom.get_id())))
-                .value()
-            )
-            dups = set(dups)
-            dups.remove(UUIDPair((atom.get_id(), atom.get_id())))
-            return list(dups)
-
-        dups = py_.map(atoms, find_dups)
-        dups = set(py_.flatten(dups))
-
-        def split_groups(acc, ne):
-            a, b = ne.a, ne.b
-            idx = py_.find_index(acc, lambda s: a in s or b in s)
-            if idx == -1:
-                return acc + [{a, b}]
-            target = acc[idx] | {a, b}
-            return acc[0:idx] + [target] + acc[idx + 1 :]
-
-        dup_groups = py_.reduce(dups, split_groups, [])
-        atoms = deepcopy(atoms)
-        bonds = deepcopy(bonds)
-        for group in dup_groups:
-            group = list(group)
-            kept, removed = group[0], group[1:]
-            connected = {}
-            for atom in removed:
-                targets = py_.filter(bonds.keys(), lambda ap: ap.has_uuid(atom))
-                if len(targets) == 0:
-                    pass
-                else:
-                    bond_type = bonds[targets[0]]
-                    anothers = py_.map(targets, lambda ap: ap.another_atom(atom))
-                    connected = connected | {another: bond_type for another in anothers}
-                    for target in targets:
-                        bonds.pop(target)
-            bonds = bonds | {
-                UUIDPair((kept, another)): connected[another]
-                for another in connected.keys()
-            }
-            atoms = py_.filter(atoms, lambda atom: atom.get_id() not in removed)
-        atoms = AtomWithId.to_atoms_dict(atoms)
-        return atoms, bonds
+    def duplicated_pairs(self, molecule):
+        if len(molecule) < 2:
+            return np.zeros((0, 2), dtype="int64")
+        positions = molecule.positions
+        pairs = cKDTree(positions).query_pairs(self.eps, output_type="ndarray")
+        distances = np.linalg.norm(positions[pairs[:, 0]] - positions[pairs[:, 1]], axis=1)
+        same_element = molecule.elements[pairs[:, 0]] == molecule.elements[pairs[:, 1]]
+        return pairs[(distances < self.eps) & same_element]
+
+    def transform(self, molecule):
+        pairs = self.duplicated_pairs(molecule)
+        if len(pairs) == 0:
+            return molecule
+        groups = DisjointSet(len(molecule))
+        groups.union_pairs(pairs)
+        representatives = groups.roots()
+        kept = representatives == np.arange(len(molecule))
+        new_rows = np.cumsum(kept) - 1
+
+        n = kept.sum()
+        bonds = np.sort(new_rows[representatives[molecule.bonds]], axis=1)
+        not_self = bonds[:, 0] != bonds[:, 1]
+        keys = bonds[:, 0] * n + bonds[:, 1]
+        _, first = np.unique(keys, return_index=True)
+        first = np.sort(first[not_self[first]])
+
+        deduped = molecule.take(kept)
+        return deduped.with_bonds(bonds[first], molecule.bond_orders[first])
+
+    def incremental(self):
+        return DedupStage(self.eps)
 
     @property
     def export(self):
         return {"type": "dedup", "eps": self.eps}
 
 
-class AutoBondLayer:
+class DedupStage(IncrementalStage):
+    """
+    `DedupLayer`的增量版本: 只重新合并被修改原子原来与现在所在的组, 每组保留在全量变换中行号最小的原子
+    """
+
+    def __init__(self, eps=EPS) -> None:
+        super().__init__()
+        self.eps = eps
+        self.grid = SpatialGrid(eps)
+        self.inputs = {}
+        self.orders = {}
+        self.representatives = {}
+        self.groups = {}
+        self.bond_images = {}
+
+    def near(self, atom_id):
+        atom = self.inputs[atom_id]
+        for other in self.grid.near(atom.position):
+            candidate = self.inputs[other]
+            if (
+                other != atom_id
+                and candidate.element == atom.element
+                and np.linalg.norm(candidate.position - atom.position) < self.eps
+            ):
+                yield other
+
+    def __take_group(self, atom_id, touched):
+        group = self.groups.pop(self.representatives.get(atom_id), None)
+        if group is not None:
+            touched |= group
+
+    def atom_key(self, atom_id):
+        return self.orders[atom_id]
+
+    def update(self, source, atom_ids, bond_ids):
+        atoms, bonds = source.atoms, source.bonds
+        self.source = source
+        touched = set()
+        for atom_id in atom_ids:
+            self.__take_group(atom_id, touched)
+            touched.add(atom_id)
+            previous = self.inputs.pop(atom_id, None)
+            if previous is not None:
+                self.grid.remove(atom_id, previous.position)
+            atom = atoms.get(atom_id)
+            if atom is not None:
+                self.inputs[atom_id] = atom
+                self.grid.add(atom_id, atom.position)
+                self.orders[atom_id] = source.atom_key(atom_id)
+            else:
+                self.orders.pop(atom_id, None)
+        for atom_id in atom_ids:
+            if atom_id in self.inputs:
+                for other in self.near(atom_id):
+                    self.__take_group(other, touched)
+        for atom_id in touched:
+            self.representatives.pop(atom_id, None)
+            self.atoms.pop(atom_id, None)
+        for atom_id in touched:
+            if atom_id in self.representatives or atom_id not in self.inputs:
+                continue
+            group, queue = {atom_id}, [atom_id]
+            while len(queue) != 0:
+                for other in self.near(queue.pop()):
+                    if other not in group:
+                        group.add(other)
+                        queue.append(other)
+            representative = min(group, key=self.orders.__getitem__)
+            for member in group:
+                self.representatives[member] = representative
+            self.groups[representative] = group
+            self.atoms[representative] = self.inputs[representative]
+
+        changed_bonds = set()
+        affected = self.affected_bonds(bonds, touched, bond_ids)
+        # unlink all before linking, the key of an input bond may be taken over by another one
+        for bond_id in affected:
+            previous = self.bond_images.pop(bond_id, None)
+            if previous is not None:
+                self.unlink(*previous, changed_bonds)
+        for bond_id in affected:
+            bond = IncrementalStage.bond_of(atoms, bonds, bond_id)
+            if bond is None:
+                continue
+            a, b = self.representatives[bond_id.a], self.representatives[bond_id.b]
+            if a != b:
+                self.bond_images[bond_id] = (UUIDPair((a, b)), source.bond_key(bond_id))
+                self.link(*self.bond_images[bond_id], bond, changed_bonds)
+        return touched, changed_bonds
+
+
+class AutoBondLayer(MoleculeTransformer):
+    """
+    根据共价半径自动生成键: 通过KD树查找距离不超过最大成键距离的原子对, 再与元素对的成键距离矩阵比较
+    """
+
     def __init__(self, radius_table = default_radius_table) -> None:
-        elements = radius_table.keys()
-        self.elements_table = py_.flatten(
-            py_.map(elements, lambda e1: py_.map(elements, lambda e2: (e1, e2)))
+        self.radius_table = dict(radius_table)
+        self.elements = list(self.radius_table.keys())
+        self.element_codes = {element: code for code, element in enumerate(self.elements)}
+        self.radiuses = np.array(
+            [self.radius_table[element] for element in self.elements], dtype="float64"
         )
-        radiuses = py_.map(elements, lambda element: radius_table[element])
-        self.bond_length_matrix = py_.flatten(
-            py_.map(radiuses, lambda r1: py_.map(radiuses, lambda r2: r1 + r2))
-        )
-        self.max_bond_length = np.array(self.bond_length_matrix, dtype="float64").max()
+        self.bond_length_matrix = self.radiuses[:, None] + self.radiuses[None, :]
+        self.max_bond_length = self.bond_length_matrix.max()
 
     def elements_max_bond_length(self, target):
-        idx = py_.find_index(self.elements_table, lambda item: item == target)
-        if idx == -1:
+        a, b = (self.element_codes.get(element) for element in target)
+        if a is None or b is None:
             return None
-        return self.bond_length_matrix[idx]
+        return self.bond_length_matrix[a, b]
 
-    def __call__(self, atoms, bonds):
-        atom_with_ids = AtomWithId.from_atoms(atoms)
-        available = py_.map(atom_with_ids, lambda atom: (atom, py_.chain(atom_with_ids).filter(lambda candidate: candidate != atom).map(lambda candidate: (candidate, np.linalg.norm(candidate.position - atom.position))).filter(lambda atom_distance: atom_distance[1] <= self.max_bond_length).value()))
-        bonds_to_add = {}
-        for (atom, candidates) in available:
-            for (candidate, distance) in candidates:
-                uuid_pair =UUIDPair((atom.get_id(), candidate.get_id()))
-                elements = (atom.element, candidate.element)
-                max_length = self.elements_max_bond_length(elements)
-                if(distance <= max_length):
-                    bonds_to_add[uuid_pair] = 1.0
-        
-        return atoms, bonds_to_add | bonds
+    def encode(self, elements):
+        return np.array(
+            [self.element_codes.get(element, -1) for element in elements], dtype="int64"
+        )
+
+    def transform(self, molecule):
+        codes = self.encode(molecule.elements)
+        known = np.flatnonzero(codes >= 0)
+        if len(known) < 2:
+            return molecule
+        codes = codes[known]
+        positions = molecule.positions[known]
+        cutoff = 2 * self.radiuses[codes].max()
+        pairs = cKDTree(positions).query_pairs(cutoff, output_type="ndarray")
+        distances = np.linalg.norm(positions[pairs[:, 0]] - positions[pairs[:, 1]], axis=1)
+        pairs = pairs[distances <= self.bond_length_matrix[codes[pairs[:, 0]], codes[pairs[:, 1]]]]
+        pairs = known[pairs]
+
+        # existed bonds keep their orders
+        n = len(molecule)
+        existed = np.sort(molecule.bonds, axis=1)
+        pairs = pairs[~np.isin(pairs[:, 0] * n + pairs[:, 1], existed[:, 0] * n + existed[:, 1])]
+        return molecule.with_bonds(
+            np.concatenate([molecule.bonds, pairs]),
+            np.concatenate([molecule.bond_orders, object_array([1.0] * len(pairs))]),
+        )
     
+    def incremental(self):
+        return AutoBondStage(self)
+
     @property
     def export(self):
         return {
             "type": "autobond",
-            "elements": self.elements_table,
-            "max_bond_length": self.bond_length_matrix
+            "radius_table": self.radius_table,
         }
-    
\ No newline at end of file
+
+
+class AutoBondStage(IncrementalStage):
+    """
+    `AutoBondLayer`的增量版本: 只重新查找被修改原子附近的原子, 已有的键保持原来的键级
+    """
+
+    def __init__(self, layer) -> None:
+        super().__init__()
+        self.layer = layer
+        self.grid = SpatialGrid(layer.max_bond_length)
+        self.inputs = {}
+        self.generated = {}
+
+    def __bonded(self, atom_id, atom):
+        """
+        与`atom`成键的其他原子
+        """
+        code = self.layer.element_codes.get(atom.element)
+        if code is None:
+            return []
+        others = [other for other in self.grid.near(atom.position) if other != atom_id]
+        if len(others) == 0:
+            return []
+        codes = self.layer.encode([self.inputs[other].element for other in others])
+        positions = np.array([self.inputs[other].position for other in others], dtype="float64")
+        distances = np.linalg.norm(positions - atom.position, axis=1)
+        bonded = (codes >= 0) & (distances <= self.layer.bond_length_matrix[code, codes])
+        return [other for other, matched in zip(others, bonded) if matched]
+
+    def atom_key(self, atom_id):
+        return self.source.atom_key(atom_id)
+
+    def bond_key(self, bond_id):
+        # explicit bonds come first, same as `AutoBondLayer`
+        source = self.source
+        if IncrementalStage.bond_of(source.atoms, source.bonds, bond_id) is not None:
+            return (0, source.bond_key(bond_id))
+        return (1, tuple(sorted([source.atom_key(bond_id.a), source.atom_key(bond_id.b)])))
+
+    def update(self, source, atom_ids, bond_ids):
+        atoms, bonds = source.atoms, source.bonds
+        self.source = source
+        candidates = self.affected_bonds(bonds, atom_ids, bond_ids)
+        for atom_id in atom_ids:
+            for neighbor in self.generated.pop(atom_id, ()):
+                self.generated[neighbor].discard(atom_id)
+                candidates.add(UUIDPair((atom_id, neighbor)))
+            previous = self.inputs.pop(atom_id, None)
+            if previous is not None:
+                self.grid.remove(atom_id, previous.position)
+            self.atoms.pop(atom_id, None)
+            atom = atoms.get(atom_id)
+            if atom is not None:
+                self.inputs[atom_id] = atom
+                self.grid.add(atom_id, atom.position)
+                self.atoms[atom_id] = atom
+        for atom_id in atom_ids:
+            atom = self.inputs.get(atom_id)
+            if atom is None:
+                continue
+            for other in self.__bonded(atom_id, atom):
+                self.generated.setdefault(atom_id, set()).add(other)
+                self.generated.setdefault(other, set()).add(atom_id)
+                candidates.add(UUIDPair((atom_id, other)))
+
+        changed_bonds = set()
+        for bond_id in candidates:
+            bond = IncrementalStage.bond_of(atoms, bonds, bond_id)
+            if bond is None and bond_id.b in self.generated.get(bond_id.a, ()):
+                bond = 1.0
+            if bond is not None:
+                self.bonds[bond_id] = bond
+            else:
+                self.bonds.pop(bond_id, None)
+            changed_bonds.add(bond_id)
+        return set(atom_ids), changed_bonds
+
+
+if __name__ == "__main__":
+    # check that incremental stages give the same structure as full transforms after random edits:
+    # python -m layers.UtilLayers
+    import random
+    from layers.EditableLayer import EditableLayer
+    from layers.StaticLayer import StaticLayer
+    from layers.UtilLayers import AutoBondLayer, DedupLayer, IncrementalPipeline
+    from layers.SymmetryLayers import InverseLayer, MirrorLayer, PointGroupLayer, RotationLayer
+
+    def canonical(atoms, bonds):
+        def key(atom):
+            return (atom.element, *(np.round(atom.position, 5) + 0.0))
+
+        return (
+            sorted(key(atom) for atom in atoms.values()),
+            sorted(tuple(sorted([key(atoms[bond_id.a]), key(atoms[bond_id.b])])) + (bond,) for bond_id, bond in bonds.items()),
+        )
+
+    def edit(layer):
+        atom_ids = list(layer.atom_ids)
+        choice = random.random()
+        if choice < 0.3 or len(atom_ids) < 3:
+            # on a coarse grid, so that deduplicated atoms and merged bonds are common
+            position = np.array([random.randint(-1, 1) for _ in range(3)], dtype="float64") * 0.6
+            layer.add_atoms([Atom(random.choice("CCN"), position)])
+        elif choice < 0.45:
+            layer.select(random.sample(atom_ids, 2))
+            layer.translation_selected(np.array([random.choice([-0.6, 0.0, 0.6]) for _ in range(3)]))
+            layer.deselect_all()
+        elif choice < 0.6:
+            layer.select(random.sample(atom_ids, 1))
+            layer.remove_selected()
+        elif choice < 0.9:
+            a, b = random.sample(atom_ids, 2)
+            layer.set_bond(a, b, random.choice([1.0, 2.0, 3.0, None]))
+        else:
+            layer.select(random.sample(atom_ids, 1))
+            layer.set_element_selected(random.choice("CN"))
+            layer.deselect_all()
+
+    pipelines = [
+        [InverseLayer()], [MirrorLayer([0, 0, 1])], [RotationLayer([0, 0, 1], 3)],
+        [RotationLayer([0, 0, 1], 3, "S")], [RotationLayer([0, 0, 1], 4, "I")],
+        [PointGroupLayer("D3h")], [PointGroupLayer("C2v")], [DedupLayer(0.5)], [AutoBondLayer()],
+        [MirrorLayer([1, 0, 0]), DedupLayer(0.5), AutoBondLayer()],
+    ]
+    for seed, transformers in enumerate(pipelines):
+        random.seed(seed)
+        layer = EditableLayer()
+        pipeline = IncrementalPipeline(layer, transformers)
+        for step in range(200):
+            edit(layer)
+            full = StaticLayer(contains=(layer, transformers))
+            assert canonical(pipeline.atoms, pipeline.bonds) == canonical(full.atoms, full.bonds), (
+                f"{[type(transformer).__name__ for transformer in transformers]} differs at step {step}"
+            )
+        print(f"{[type(transformer).__name__ for transformer in transformers]}: OK")
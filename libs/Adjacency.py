@@ -0,0 +1,49 @@
+class Adjacency:
+    """
+    键的邻接表: 原子ID -> {相邻原子ID: 键级}
+
+    与`AtomIndex`相同, 可以叠加在基础邻接表之上, 只有被修改的原子的邻接关系会从基础邻接表中复制。
+    """
+
+    def __init__(self, base=None) -> None:
+        self.base = base
+        self.table = {}
+
+    @staticmethod
+    def from_bonds(bonds):
+        adjacency = Adjacency()
+        for bond_id, bond in bonds.items():
+            adjacency.set(bond_id, bond)
+        return adjacency
+
+    def __find(self, atom_id):
+        adjacency = self
+        while adjacency is not None:
+            neighbors = adjacency.table.get(atom_id)
+            if neighbors is not None:
+                return neighbors
+            adjacency = adjacency.base
+        return None
+
+    def __own(self, atom_id):
+        neighbors = self.table.get(atom_id)
+        if neighbors is None:
+            inherited = self.base.__find(atom_id) if self.base is not None else None
+            neighbors = dict(inherited) if inherited is not None else {}
+            self.table[atom_id] = neighbors
+        return neighbors
+
+    def set(self, bond_id, bond):
+        """
+        设置键`bond_id`的键级, `bond`为`None`时删除该键
+        """
+        a, b = bond_id.a, bond_id.b
+        if bond is None:
+            self.__own(a).pop(b, None)
+            self.__own(b).pop(a, None)
+        else:
+            self.__own(a)[b] = bond
+            self.__own(b)[a] = bond
+
+    def neighbors(self, atom_id):
+        return self.__find(atom_id) or {}
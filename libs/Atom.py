@@ -5,7 +5,9 @@ import uuid
 class Atom:
     def __init__(self, element, position, class_name = "") -> None:
         self.__element = element
+        # a private read-only copy, the position can not be changed through the caller's array or the atom
         self.__position = np.array(position, dtype="float64")
+        self.__position.flags.writeable = False
         self.class_name = class_name
 
     @property
@@ -59,9 +61,12 @@ class AtomWithId(Atom):
         }
 
     def __init__(self, atom_id, atom):
-        super().__init__(atom.element, atom.position)
+        super().__init__(atom.element, atom.position, atom.class_name)
         self.__id = atom_id
 
+    def __to_atom(self):
+        return Atom(self.element, self.position, self.class_name)
+
     def get_id(self):
         return self.__id
 
@@ -0,0 +1,70 @@
+class AtomIndex:
+    """
+    类名标记(`class_name`按空格切分)与元素符号到原子ID的倒排索引
+
+    可以叠加在另一个索引(如`StaticLayer`的索引)之上, 只有被修改的桶会从基础索引中复制一份, 基础索引本身不会被修改。
+    查询结果按原子加入索引的顺序排列。
+    """
+
+    def __init__(self, base=None) -> None:
+        self.base = base
+        self.class_names = {}
+        self.elements = {}
+
+    @staticmethod
+    def from_atoms(atoms):
+        index = AtomIndex()
+        for atom_id, atom in atoms.items():
+            if atom is not None:
+                index.add(atom_id, atom)
+        return index
+
+    @staticmethod
+    def tokens(atom):
+        return atom.class_name.split(" ")
+
+    def __find(self, table, key):
+        index = self
+        while index is not None:
+            bucket = getattr(index, table).get(key)
+            if bucket is not None:
+                return bucket
+            index = index.base
+        return None
+
+    def __own(self, table, key):
+        own = getattr(self, table)
+        bucket = own.get(key)
+        if bucket is None:
+            inherited = self.base.__find(table, key) if self.base is not None else None
+            bucket = dict(inherited) if inherited is not None else {}
+            own[key] = bucket
+        return bucket
+
+    def add(self, atom_id, atom):
+        for token in AtomIndex.tokens(atom):
+            self.__own("class_names", token)[atom_id] = None
+        self.__own("elements", atom.element)[atom_id] = None
+
+    def remove(self, atom_id, atom):
+        for token in AtomIndex.tokens(atom):
+            self.__own("class_names", token).pop(atom_id, None)
+        self.__own("elements", atom.element).pop(atom_id, None)
+
+    def replace(self, atom_id, old, new):
+        """
+        将原子`old`替换为`new`, 任一方为`None`表示原子不存在
+        """
+        if old is not None and new is not None:
+            if old.element == new.element and old.class_name == new.class_name:
+                return
+        if old is not None:
+            self.remove(atom_id, old)
+        if new is not None:
+            self.add(atom_id, new)
+
+    def with_class_name(self, class_name):
+        return list(self.__find("class_names", class_name) or ())
+
+    def with_element(self, element):
+        return list(self.__find("elements", element) or ())
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class DisjointSet:
+    """
+    并查集, 元素为0..n-1的整数, 每个集合以其中最小的元素为代表
+    """
+
+    def __init__(self, n) -> None:
+        self.parents = np.arange(n)
+
+    def find(self, x):
+        parents = self.parents
+        root = x
+        while parents[root] != root:
+            root = parents[root]
+        while parents[x] != root:
+            parents[x], x = root, parents[x]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a < b:
+            self.parents[b] = a
+        elif b < a:
+            self.parents[a] = b
+
+    def union_pairs(self, pairs):
+        for a, b in pairs:
+            self.union(a, b)
+
+    def roots(self):
+        """
+        返回每个元素所在集合的代表
+        """
+        roots = self.parents.copy()
+        while True:
+            updated = roots[roots]
+            if np.array_equal(updated, roots):
+                return roots
+            roots = updated
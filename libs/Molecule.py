@@ -0,0 +1,286 @@
+import os
+import hashlib
+import numpy as np
+from uuid import UUID
+from libs.Atom import Atom
+from libs.UUIDPair import UUIDPair
+
+
+def object_array(values):
+    values = list(values)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def ids_from_bytes(block):
+    """
+    由连续的16字节块构建UUID数组
+    """
+    return object_array(UUID(bytes=block[i : i + 16]) for i in range(0, len(block), 16))
+
+
+def new_ids(n):
+    """
+    一次性生成n个随机UUID(version 4)
+    """
+    block = os.urandom(16 * n)
+    return object_array(
+        UUID(bytes=block[i : i + 16], version=4) for i in range(0, 16 * n, 16)
+    )
+
+
+class Molecule:
+    """
+    列式存储的分子结构
+
+    - ids: (N,) 原子UUID
+    - elements, class_names: (N,) 元素符号与类名
+    - positions: (N,3) float64 连续坐标块
+    - bonds: (M,2) 键两端原子的行号
+    - bond_orders: (M,) 键级
+
+    Molecule 视为不可变对象, 所有变换均返回新的 Molecule, 未改变的数组在新旧对象之间共享。
+    """
+
+    def __init__(
+        self,
+        ids=(),
+        elements=(),
+        class_names=None,
+        positions=None,
+        bonds=None,
+        bond_orders=(),
+    ) -> None:
+        self.ids = ids if isinstance(ids, np.ndarray) else object_array(ids)
+        self.elements = (
+            elements if isinstance(elements, np.ndarray) else object_array(elements)
+        )
+        if class_names is None:
+            class_names = [""] * len(self.ids)
+        self.class_names = (
+            class_names
+            if isinstance(class_names, np.ndarray)
+            else object_array(class_names)
+        )
+        if positions is None:
+            positions = np.zeros((0, 3))
+        self.positions = np.ascontiguousarray(positions, dtype="float64").reshape(-1, 3)
+        self.positions.flags.writeable = False
+        if bonds is None:
+            bonds = np.zeros((0, 2))
+        self.bonds = np.asarray(bonds, dtype="int64").reshape(-1, 2)
+        self.bond_orders = (
+            bond_orders
+            if isinstance(bond_orders, np.ndarray)
+            else object_array(bond_orders)
+        )
+        self.__index = None
+        self.__adjacency = None
+        if not (
+            len(self.ids) == len(self.elements) == len(self.class_names) == len(self.positions)
+        ):
+            raise ValueError("Atom columns have different lengths")
+        if len(self.bonds) != len(self.bond_orders):
+            raise ValueError("Bond columns have different lengths")
+
+    @staticmethod
+    def from_atoms_bonds(atoms, bonds):
+        """
+        从`dict[UUID, Atom]`与`dict[UUIDPair, order]`构建, 值为`None`的原子、键以及端点不存在的键会被丢弃
+        """
+        atom_ids = [atom_id for atom_id in atoms.keys() if atoms[atom_id] is not None]
+        existed = [atoms[atom_id] for atom_id in atom_ids]
+        positions = (
+            np.array([atom.position for atom in existed], dtype="float64")
+            if len(existed) != 0
+            else None
+        )
+        index = {atom_id: i for i, atom_id in enumerate(atom_ids)}
+        bond_rows, bond_orders = [], []
+        for bond_id, order in bonds.items():
+            if order is None:
+                continue
+            a, b = index.get(bond_id.a), index.get(bond_id.b)
+            if a is None or b is None:
+                continue
+            bond_rows.append((a, b))
+            bond_orders.append(order)
+        molecule = Molecule(
+            atom_ids,
+            [atom.element for atom in existed],
+            [atom.class_name for atom in existed],
+            positions,
+            bond_rows if len(bond_rows) != 0 else None,
+            bond_orders,
+        )
+        molecule.__index = index
+        return molecule
+
+    @staticmethod
+    def concat(molecules):
+        """
+        按顺序拼接多个分子, 键的行号按原子数偏移
+        """
+        molecules = list(molecules)
+        if len(molecules) == 0:
+            return Molecule()
+        offsets = np.cumsum([0] + [len(molecule) for molecule in molecules[:-1]])
+        return Molecule(
+            np.concatenate([molecule.ids for molecule in molecules]),
+            np.concatenate([molecule.elements for molecule in molecules]),
+            np.concatenate([molecule.class_names for molecule in molecules]),
+            np.concatenate([molecule.positions for molecule in molecules]),
+            np.concatenate(
+                [molecule.bonds + offset for molecule, offset in zip(molecules, offsets)]
+            ),
+            np.concatenate([molecule.bond_orders for molecule in molecules]),
+        )
+
+    def __getstate__(self):
+        return {
+            "ids": b"".join(atom_id.bytes for atom_id in self.ids),
+            "elements": list(self.elements),
+            "class_names": list(self.class_names),
+            "positions": np.array(self.positions),
+            "bonds": self.bonds,
+            "bond_orders": list(self.bond_orders),
+        }
+
+    def __setstate__(self, state):
+        self.__init__(
+            ids_from_bytes(state["ids"]),
+            state["elements"],
+            state["class_names"],
+            state["positions"],
+            state["bonds"],
+            state["bond_orders"],
+        )
+
+    def digest(self):
+        """
+        与原子UUID无关的内容哈希(元素、类名、坐标、键与键级), 内容相同的分子结果相同
+        """
+        content = hashlib.sha256()
+        content.update("\0".join(self.elements).encode())
+        content.update(b"\1")
+        content.update("\0".join(self.class_names).encode())
+        content.update(b"\1")
+        content.update(self.positions.tobytes())
+        content.update(self.bonds.tobytes())
+        content.update("\0".join(str(order) for order in self.bond_orders).encode())
+        return content.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def index(self):
+        """
+        UUID -> 行号
+        """
+        if self.__index is None:
+            self.__index = {atom_id: i for i, atom_id in enumerate(self.ids)}
+        return self.__index
+
+    @property
+    def adjacency(self):
+        """
+        CSR形式的邻接表(indptr, neighbors, bond_rows): 第i行原子的相邻原子为`neighbors[indptr[i]:indptr[i+1]]`, 对应的键为`bond_rows`中的同一区间
+        """
+        if self.__adjacency is None:
+            n, m = len(self), len(self.bonds)
+            sources = np.concatenate([self.bonds[:, 0], self.bonds[:, 1]])
+            targets = np.concatenate([self.bonds[:, 1], self.bonds[:, 0]])
+            bond_rows = np.concatenate([np.arange(m), np.arange(m)])
+            order = np.argsort(sources, kind="stable")
+            indptr = np.zeros(n + 1, dtype="int64")
+            np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+            self.__adjacency = (indptr, targets[order], bond_rows[order])
+        return self.__adjacency
+
+    def neighbors(self, row):
+        """
+        返回第`row`行原子的相邻原子行号与对应的键行号
+        """
+        indptr, neighbors, bond_rows = self.adjacency
+        return neighbors[indptr[row] : indptr[row + 1]], bond_rows[indptr[row] : indptr[row + 1]]
+
+    def rows(self, atom_ids):
+        index = self.index
+        return np.array([index[atom_id] for atom_id in atom_ids], dtype="int64")
+
+    def atom(self, atom_id):
+        """
+        返回某一原子的`Atom`, 坐标为复制的只读数组
+        """
+        row = self.index[atom_id]
+        return Atom(self.elements[row], self.positions[row], self.class_names[row])
+
+    @property
+    def atoms(self):
+        return {
+            atom_id: Atom(element, position, class_name)
+            for atom_id, element, class_name, position in zip(
+                self.ids, self.elements, self.class_names, self.positions
+            )
+        }
+
+    @property
+    def bond_ids(self):
+        ids = self.ids
+        return [UUIDPair((ids[a], ids[b])) for a, b in self.bonds]
+
+    @property
+    def bonds_dict(self):
+        return {
+            bond_id: order for bond_id, order in zip(self.bond_ids, self.bond_orders)
+        }
+
+    def to_atoms_bonds(self):
+        return self.atoms, self.bonds_dict
+
+    def with_positions(self, positions):
+        return Molecule(
+            self.ids,
+            self.elements,
+            self.class_names,
+            positions,
+            self.bonds,
+            self.bond_orders,
+        )
+
+    def with_bonds(self, bonds, bond_orders):
+        molecule = Molecule(
+            self.ids,
+            self.elements,
+            self.class_names,
+            self.positions,
+            bonds,
+            bond_orders,
+        )
+        molecule.__index = self.__index
+        return molecule
+
+    def take(self, rows):
+        """
+        按行号(或布尔掩码)取出部分原子, 仅保留两端都被取出的键
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        remap = np.full(len(self), -1, dtype="int64")
+        remap[rows] = np.arange(len(rows))
+        bonds = remap[self.bonds]
+        kept = (bonds >= 0).all(axis=1)
+        return Molecule(
+            self.ids[rows],
+            self.elements[rows],
+            self.class_names[rows],
+            self.positions[rows],
+            bonds[kept],
+            self.bond_orders[kept],
+        )
+
+    def __repr__(self) -> str:
+        return f"Molecule({len(self)} atoms, {len(self.bonds)} bonds)"
@@ -0,0 +1,334 @@
+from collections.abc import Mapping
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_MASK = (1 << 64) - 1
+
+
+def key_hash(key):
+    return hash(key) & HASH_MASK
+
+
+class Node:
+    """
+    HAMT的分支节点, `children`按`bitmap`中置位的顺序存放子节点、叶子`(hash, key, value)`或`Collision`
+    """
+
+    __slots__ = ("bitmap", "children")
+
+    def __init__(self, bitmap, children) -> None:
+        self.bitmap = bitmap
+        self.children = children
+
+
+class Collision:
+    """
+    hash完全相同的多个键值对
+    """
+
+    __slots__ = ("hash", "entries")
+
+    def __init__(self, hash, entries) -> None:
+        self.hash = hash
+        self.entries = entries
+
+
+EMPTY = Node(0, ())
+
+
+def entry_hash(entry):
+    return entry.hash if isinstance(entry, Collision) else entry[0]
+
+
+def merge(shift, a, b):
+    """
+    将两个hash不同的叶子(或Collision)合并到深度为`shift`的新节点中
+    """
+    a_hash, b_hash = entry_hash(a), entry_hash(b)
+    a_idx, b_idx = (a_hash >> shift) & MASK, (b_hash >> shift) & MASK
+    if a_idx == b_idx:
+        return Node(1 << a_idx, (merge(shift + BITS, a, b),))
+    children = (a, b) if a_idx < b_idx else (b, a)
+    return Node((1 << a_idx) | (1 << b_idx), children)
+
+
+def assoc(node, shift, h, key, value):
+    """
+    返回(新节点, 是否新增了键)
+    """
+    bit = 1 << ((h >> shift) & MASK)
+    pos = (node.bitmap & (bit - 1)).bit_count()
+    children = node.children
+    if not node.bitmap & bit:
+        return (
+            Node(node.bitmap | bit, children[:pos] + ((h, key, value),) + children[pos:]),
+            True,
+        )
+    child = children[pos]
+    added = False
+    if isinstance(child, Node):
+        child, added = assoc(child, shift + BITS, h, key, value)
+    elif isinstance(child, Collision):
+        if child.hash == h:
+            entries = tuple(entry for entry in child.entries if entry[0] != key)
+            added = len(entries) == len(child.entries)
+            child = Collision(h, entries + ((key, value),))
+        else:
+            child, added = merge(shift + BITS, child, (h, key, value)), True
+    else:
+        child_hash, child_key, child_value = child
+        if child_hash == h and child_key == key:
+            if child_value is value:
+                return node, False
+            child = (h, key, value)
+        elif child_hash == h:
+            child, added = Collision(h, ((child_key, child_value), (key, value))), True
+        else:
+            child, added = merge(shift + BITS, child, (h, key, value)), True
+    return Node(node.bitmap, children[:pos] + (child,) + children[pos + 1 :]), added
+
+
+def dissoc(node, shift, h, key):
+    """
+    返回删除键后的节点(无剩余内容时为`None`), 键不存在时返回原节点
+    """
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit:
+        return node
+    pos = (node.bitmap & (bit - 1)).bit_count()
+    children = node.children
+    child = children[pos]
+    if isinstance(child, Node):
+        updated = dissoc(child, shift + BITS, h, key)
+        if updated is child:
+            return node
+        # inline a branch which only holds a single leaf
+        if updated is not None and len(updated.children) == 1 and not isinstance(updated.children[0], Node):
+            updated = updated.children[0]
+    elif isinstance(child, Collision):
+        if child.hash != h:
+            return node
+        entries = tuple(entry for entry in child.entries if entry[0] != key)
+        if len(entries) == len(child.entries):
+            return node
+        updated = Collision(h, entries) if len(entries) > 1 else (h, *entries[0])
+    else:
+        if child[0] != h or child[1] != key:
+            return node
+        updated = None
+    if updated is None:
+        if len(children) == 1:
+            return None
+        return Node(node.bitmap & ~bit, children[:pos] + children[pos + 1 :])
+    return Node(node.bitmap, children[:pos] + (updated,) + children[pos + 1 :])
+
+
+def find(node, h, key, default):
+    shift = 0
+    while True:
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return default
+        child = node.children[(node.bitmap & (bit - 1)).bit_count()]
+        if isinstance(child, Node):
+            node = child
+            shift += BITS
+        elif isinstance(child, Collision):
+            for entry_key, entry_value in child.entries:
+                if entry_key == key:
+                    return entry_value
+            return default
+        else:
+            return child[2] if child[1] == key else default
+
+
+def vector_set(node, shift, index, value):
+    if shift == 0:
+        position = index & MASK
+        return node[:position] + (value,) + node[position + 1 :]
+    position = (index >> shift) & MASK
+    return node[:position] + (vector_set(node[position], shift - BITS, index, value),) + node[position + 1 :]
+
+
+def vector_push(node, shift, index, value):
+    position = (index >> shift) & MASK
+    if shift == 0:
+        return node + (value,)
+    if position < len(node):
+        return node[:position] + (vector_push(node[position], shift - BITS, index, value),)
+    return node + (vector_path(shift - BITS, value),)
+
+
+def vector_path(shift, value):
+    if shift == 0:
+        return (value,)
+    return (vector_path(shift - BITS, value),)
+
+
+def vector_walk(node, shift):
+    if shift == 0:
+        yield from node
+    else:
+        for child in node:
+            yield from vector_walk(child, shift - BITS)
+
+
+class PersistentVector:
+    """
+    不可变的向量(32叉trie), 追加与按下标修改为O(log N)
+    """
+
+    __slots__ = ("root", "shift", "count")
+
+    def __init__(self, root=(), shift=0, count=0) -> None:
+        self.root = root
+        self.shift = shift
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+        node = self.root
+        for shift in range(self.shift, 0, -BITS):
+            node = node[(index >> shift) & MASK]
+        return node[index & MASK]
+
+    def __iter__(self):
+        return vector_walk(self.root, self.shift)
+
+    def append(self, value):
+        if self.count == 1 << (self.shift + BITS):
+            root = (self.root, vector_path(self.shift, value))
+            return PersistentVector(root, self.shift + BITS, self.count + 1)
+        return PersistentVector(
+            vector_push(self.root, self.shift, self.count, value), self.shift, self.count + 1
+        )
+
+    def set(self, index, value):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+        return PersistentVector(vector_set(self.root, self.shift, index, value), self.shift, self.count)
+
+
+MISSING = object()
+EMPTY_VECTOR = PersistentVector()
+
+
+class PersistentMap(Mapping):
+    """
+    不可变的有序哈希映射, 修改操作返回新的映射并与原映射共享未改变的部分, 单次修改为O(log N)
+
+    键到序号的映射保存在HAMT中, 键值对按插入顺序保存在`PersistentVector`中, 迭代顺序与`dict`相同。
+    `|`运算与`dict`一致, 返回合并后的新映射; `dict | PersistentMap`返回`dict`
+    """
+
+    __slots__ = ("__root", "__entries", "__size")
+
+    def __init__(self, items=None) -> None:
+        self.__root = EMPTY
+        self.__entries = EMPTY_VECTOR
+        self.__size = 0
+        if items is not None:
+            self.__root, self.__entries, self.__size = self.__assoc_all(items)
+
+    @staticmethod
+    def __create(root, entries, size):
+        created = PersistentMap()
+        created.__root = root
+        created.__entries = entries
+        created.__size = size
+        # compact when removed entries outnumber the existed ones
+        if len(entries) > 32 and len(entries) > 2 * size:
+            return PersistentMap(created.items())
+        return created
+
+    def __assoc_all(self, items):
+        items = items.items() if isinstance(items, Mapping) else items
+        root, entries, size = self.__root, self.__entries, self.__size
+        for key, value in items:
+            h = key_hash(key)
+            index = find(root, h, key, MISSING)
+            if index is MISSING:
+                root, _ = assoc(root, 0, h, key, len(entries))
+                entries = entries.append((key, value))
+                size += 1
+            elif entries[index][1] is not value:
+                entries = entries.set(index, (key, value))
+        return root, entries, size
+
+    def __getitem__(self, key):
+        index = find(self.__root, key_hash(key), key, MISSING)
+        if index is MISSING:
+            raise KeyError(key)
+        return self.__entries[index][1]
+
+    def get(self, key, default=None):
+        index = find(self.__root, key_hash(key), key, MISSING)
+        if index is MISSING:
+            return default
+        return self.__entries[index][1]
+
+    def __contains__(self, key) -> bool:
+        return find(self.__root, key_hash(key), key, MISSING) is not MISSING
+
+    def position(self, key):
+        """
+        键在插入顺序中的位置, 键不存在时返回None
+        """
+        index = find(self.__root, key_hash(key), key, MISSING)
+        return None if index is MISSING else index
+
+    def __walk(self):
+        for entry in self.__entries:
+            if entry is not None:
+                yield entry
+
+    def __iter__(self):
+        for key, _ in self.__walk():
+            yield key
+
+    def items(self):
+        return list(self.__walk())
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def set(self, key, value):
+        return self.update(((key, value),))
+
+    def delete(self, key):
+        h = key_hash(key)
+        index = find(self.__root, h, key, MISSING)
+        if index is MISSING:
+            return self
+        root = dissoc(self.__root, 0, h, key)
+        return PersistentMap.__create(
+            root if root is not None else EMPTY, self.__entries.set(index, None), self.__size - 1
+        )
+
+    def update(self, items):
+        root, entries, size = self.__assoc_all(items)
+        if entries is self.__entries:
+            return self
+        return PersistentMap.__create(root, entries, size)
+
+    def __or__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.update(other)
+
+    def __ror__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        merged = dict(other)
+        merged.update(self.__walk())
+        return merged
+
+    def __reduce__(self):
+        return (PersistentMap, (self.items(),))
+
+    def __repr__(self) -> str:
+        return f"PersistentMap({dict(self.__walk())})"
@@ -0,0 +1,35 @@
+import numpy as np
+
+
+class SpatialGrid:
+    """
+    按边长为`size`的立方格子索引原子坐标, 用于逐个原子地查找距离不超过`size`的原子, 支持增删
+    """
+
+    def __init__(self, size) -> None:
+        self.size = size
+        self.cells = {}
+
+    def cell(self, position):
+        return tuple(int(value) for value in np.floor(np.asarray(position) / self.size))
+
+    def add(self, atom_id, position):
+        self.cells.setdefault(self.cell(position), set()).add(atom_id)
+
+    def remove(self, atom_id, position):
+        cell = self.cell(position)
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(atom_id)
+            if len(members) == 0:
+                del self.cells[cell]
+
+    def near(self, position):
+        """
+        产生`position`所在格子及相邻26个格子中的原子ID, 距离需由调用者再判断
+        """
+        x, y, z = self.cell(position)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    yield from self.cells.get((x + dx, y + dy, z + dz), ())
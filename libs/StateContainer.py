@@ -1,30 +1,210 @@
+from collections.abc import Mapping, Set
+from contextlib import contextmanager
 from copy import deepcopy
 from libs.constants import PRODUCTION
 
 
+class Delta:
+    """
+    一个状态槽位的修改: 新增(added)、删除(removed)与修改(modified)的键, 集合类型的槽位以元素为键
+
+    无法按键比较的槽位被整体替换时`replaced`为True
+    """
+
+    __slots__ = ("added", "removed", "modified", "replaced")
+
+    def __init__(self, added=frozenset(), removed=frozenset(), modified=frozenset(), replaced=False) -> None:
+        self.added = frozenset(added)
+        self.removed = frozenset(removed)
+        self.modified = frozenset(modified)
+        self.replaced = replaced
+
+    @property
+    def keys(self):
+        return self.added | self.removed | self.modified
+
+    def __bool__(self) -> bool:
+        return self.replaced or len(self.added) != 0 or len(self.removed) != 0 or len(self.modified) != 0
+
+    def __repr__(self) -> str:
+        return f"Delta(added={set(self.added)}, removed={set(self.removed)}, modified={set(self.modified)}, replaced={self.replaced})"
+
+
+UNCHANGED = Delta()
+
+
+def same_value(a, b):
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        return False
+
+
+def slot_delta(previous, current, keys=None, same=same_value):
+    """
+    比较一个槽位修改前后的值, `keys`为可能被修改的键, 为None时比较全部的键
+    """
+    if previous is current:
+        return UNCHANGED
+    if isinstance(previous, Set) and isinstance(current, Set):
+        if keys is None:
+            return Delta(current - previous, previous - current)
+        return Delta(
+            [key for key in keys if key in current and key not in previous],
+            [key for key in keys if key in previous and key not in current],
+        )
+    if isinstance(previous, Mapping) and isinstance(current, Mapping):
+        if keys is None:
+            keys = set(previous.keys()) | set(current.keys())
+        added, removed, modified = [], [], []
+        for key in keys:
+            if key not in previous:
+                if key in current:
+                    added.append(key)
+            elif key not in current:
+                removed.append(key)
+            elif not same(previous[key], current[key]):
+                modified.append(key)
+        return Delta(added, removed, modified)
+    return UNCHANGED if same_value(previous, current) else Delta(replaced=True)
+
+
+def merge_keys(pending, keys):
+    # None means any key might be changed, `pending` is owned by the transaction and updated in place
+    if pending is None or keys is None:
+        return None
+    pending.update(keys)
+    return pending
+
+
 class StateContainer:
-    def __init__(self, init_state=None) -> None:
+    def __init__(self, init_state=None, persistent=False) -> None:
         self.__state__ = init_state
+        # A persistent state is built only from immutable structures (PersistentMap, frozenset, tuple),
+        # updators can not change it in place, so it is never copied.
+        self.persistent = persistent
+        # Increased whenever update changes the state, derived views can be cached with it.
+        self.version = 0
         self.subscribers = set()
+        # Incremental subscribers also receive the delta of each update, see `add_subscriber`
+        self.incremental_subscribers = set()
+        # (state, keys, updated) at the start of the outermost transaction
+        self.__transaction = None
 
     @property
     def state(self):
         # In prodcution mode, return the __state__ directly
-        if PRODUCTION:
+        if PRODUCTION or self.persistent:
             return self.__state__
         # In development mode, return an copied state to avoid change the state from outside.
         return deepcopy(self.__state__)
 
-    def add_subscriber(self, subscriber):
-        self.subscribers.add(subscriber)
+    def add_subscriber(self, subscriber, incremental=False):
+        """
+        `incremental`为True时以`subscriber(state, delta)`调用: 状态为tuple时`delta`为各槽位的`Delta`组成的tuple, 否则为一个`Delta`
+        """
+        if incremental:
+            self.incremental_subscribers.add(subscriber)
+        else:
+            self.subscribers.add(subscriber)
 
     def remove_subscriber(self, subscriber):
-        self.subscribers.remove(subscriber)
+        if subscriber in self.incremental_subscribers:
+            self.incremental_subscribers.remove(subscriber)
+        else:
+            self.subscribers.remove(subscriber)
 
-    def __broadcast__(self):
+    def delta(self, previous, current, keys=None):
+        """
+        `previous`至`current`的修改, `keys`与状态的结构相同, 为各槽位可能被修改的键(None表示未知)
+        """
+        # values of a persistent state are never changed in place
+        same = (lambda a, b: a is b) if self.persistent else same_value
+        if isinstance(previous, tuple) and isinstance(current, tuple) and len(previous) == len(current):
+            keys = keys if keys is not None else (None,) * len(current)
+            return tuple(slot_delta(a, b, k, same) for a, b, k in zip(previous, current, keys))
+        return slot_delta(previous, current, keys, same)
+
+    def __broadcast__(self, previous, keys=None):
+        # the state (copied in development mode) is shared by all subscribers of a broadcast
+        state = self.state if len(self.subscribers) + len(self.incremental_subscribers) != 0 else None
         for subscriber in self.subscribers:
-            subscriber(self.state)
+            subscriber(state)
+        if len(self.incremental_subscribers) != 0:
+            delta = self.delta(previous, self.__state__, keys)
+            for subscriber in self.incremental_subscribers:
+                subscriber(state, delta)
+
+    @staticmethod
+    def __same_state(a, b):
+        if a is b:
+            return True
+        if isinstance(a, tuple) and isinstance(b, tuple) and len(a) == len(b):
+            return all(x is y for x, y in zip(a, b))
+        return False
+
+    @contextmanager
+    def transaction(self, rollback=False, validate=None):
+        """
+        事务中的多次`update`只在事务结束时广播一次, 增量订阅者收到事务开始至结束的全部修改
+
+        - rollback: 出错时恢复事务开始时的状态, 不广播
+        - validate: 结束时以全部修改(同增量订阅者收到的`delta`)调用, 抛出的错误同样会回滚
+
+        嵌套的事务只在最外层结束时广播, 但各自在开始时保存状态, 出错时回滚至该状态(savepoint), 结束时校验自身的修改
+        """
+        if self.__transaction is not None:
+            savepoint = self.__state__
+            try:
+                yield self
+                if validate is not None and self.__state__ is not savepoint:
+                    validate(self.delta(savepoint, self.__state__, self.__transaction[1]))
+            except BaseException:
+                if rollback and self.__state__ is not savepoint:
+                    self.__state__ = savepoint
+                    self.version += 1
+                raise
+            return
+        state = self.__state__
+        keys = tuple(set() for _ in state) if isinstance(state, tuple) else set()
+        self.__transaction = (state, keys, False)
+        rolled_back = False
+        try:
+            yield self
+            _, keys, updated = self.__transaction
+            if validate is not None and updated:
+                validate(self.delta(state, self.__state__, keys))
+        except BaseException:
+            if rollback:
+                if self.__state__ is not state:
+                    self.__state__ = state
+                    self.version += 1
+                rolled_back = True
+            raise
+        finally:
+            _, keys, updated = self.__transaction
+            self.__transaction = None
+            if updated and not rolled_back:
+                self.__broadcast__(state, keys)
 
-    def update(self, updator):
-        self.__state__ = updator(self.state)
-        self.__broadcast__()
+    def update(self, updator, keys=None):
+        """
+        `keys`与状态的结构相同, 为各槽位可能被修改的键, 用于计算增量订阅者收到的`Delta`; 为None时比较全部的键
+        """
+        previous = self.__state__
+        updated = updator(self.state)
+        if not StateContainer.__same_state(previous, updated):
+            self.version += 1
+        self.__state__ = updated
+        if self.__transaction is None:
+            self.__broadcast__(previous, keys)
+            return
+        start, pending, _ = self.__transaction
+        if isinstance(pending, tuple):
+            keys = keys if keys is not None else (None,) * len(pending)
+            pending = tuple(merge_keys(a, b) for a, b in zip(pending, keys))
+        else:
+            pending = merge_keys(pending, keys)
+        self.__transaction = (start, pending, True)
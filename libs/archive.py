@@ -0,0 +1,131 @@
+import io
+import json
+import os
+import re
+from libs.molecule_text import writers, molecules_from_mol2, molecules_from_sdf
+
+record_starts = {
+    "mol2": re.compile(rb"^@<TRIPOS>MOLECULE[ \t]*\r?$", re.M),
+}
+record_ends = {
+    "sdf": re.compile(rb"^\$\$\$\$[ \t]*\r?\n", re.M),
+}
+readers = {"mol2": molecules_from_mol2, "sdf": molecules_from_sdf}
+
+
+class StructureArchive:
+    """
+    将多个结构追加到同一个多分子mol2或SDF文件中, 每个结构的标签以JSON保存在分子名一行
+
+    每个结构以一次`O_APPEND`写入追加, 多个线程或进程可以同时写入同一个文件。
+    读取时扫描一遍文件得到每个结构的字节偏移, 保存在`<path>.idx`中, 文件增长后只扫描新增的部分。
+    追加不会覆盖已有的结构, 重新生成前需先`reset`。
+    """
+
+    def __init__(self, path, format=None) -> None:
+        self.path = path
+        self.format = format if format is not None else os.path.splitext(path)[1][1:]
+        if self.format not in readers:
+            raise ValueError(f"Unknown archive format {self.format}, should be one of {list(readers)}")
+        self.index_path = f"{path}.idx"
+
+    def reset(self):
+        """
+        清空文件并删除索引, 不能与`append`同时调用
+        """
+        open(self.path, "wb").close()
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def append(self, molecule, tags):
+        buffer = io.StringIO()
+        writers[self.format](buffer, molecule, name=json.dumps(tags))
+        content = buffer.getvalue().encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            written = 0
+            while written < len(content):
+                written += os.write(fd, content[written:])
+        finally:
+            os.close(fd)
+
+    def __scan(self, start):
+        """
+        返回从`start`开始的每个结构的(偏移, 长度), 没有写完的SDF记录不会被计入
+        """
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            content = file.read()
+        if self.format in record_starts:
+            offsets = [match.start() for match in record_starts[self.format].finditer(content)]
+            ends = offsets[1:] + [len(content)]
+        else:
+            ends = [match.end() for match in record_ends[self.format].finditer(content)]
+            offsets = [0] + ends[:-1]
+        return [(start + offset, end - offset) for offset, end in zip(offsets, ends)], content
+
+    @staticmethod
+    def __tags(record):
+        lines = record.decode().lstrip("\r\n").splitlines()
+        # the name is the first line of a SDF record, or the line after `@<TRIPOS>MOLECULE`
+        name = lines[1] if lines[0].startswith("@<TRIPOS>") else lines[0]
+        try:
+            return json.loads(name)
+        except ValueError:
+            return {"name": name.strip()}
+
+    def index(self):
+        """
+        返回`[(偏移, 长度, 标签)]`
+        """
+        if not os.path.exists(self.path):
+            return []
+        size = os.path.getsize(self.path)
+        index = {"size": 0, "entries": []}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                index = json.load(file)
+            if index["size"] > size:
+                index = {"size": 0, "entries": []}
+        if index["size"] < size:
+            entries = index["entries"]
+            if self.format in record_starts and len(entries) != 0:
+                # the last mol2 record may be still growing, scan again from its beginning
+                start = entries.pop()[0]
+            else:
+                start = entries[-1][0] + entries[-1][1] if len(entries) != 0 else 0
+            scanned, content = self.__scan(start)
+            entries += [
+                [offset, length, StructureArchive.__tags(content[offset - start : offset - start + length])]
+                for offset, length in scanned
+            ]
+            index = {"size": size, "entries": entries}
+            # every process writes its own temporary file, the index could be updated by several workers at once
+            temporary = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as file:
+                json.dump(index, file)
+            os.replace(temporary, self.index_path)
+        return [tuple(entry) for entry in index["entries"]]
+
+    def __len__(self) -> int:
+        return len(self.index())
+
+    def read(self, entry):
+        offset, length, tags = entry
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            record = file.read(length).decode()
+        return readers[self.format](record)[0][1], tags
+
+    def __getitem__(self, i):
+        return self.read(self.index()[i])
+
+    def find(self, tags):
+        """
+        返回标签包含`tags`中全部键值的结构`[(Molecule, 标签)]`
+        """
+        return [
+            self.read(entry)
+            for entry in self.index()
+            if all(entry[2].get(key) == value for key, value in tags.items())
+        ]
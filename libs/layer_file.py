@@ -0,0 +1,117 @@
+import json
+import struct
+import numpy as np
+from libs.Molecule import Molecule, ids_from_bytes, object_array
+
+MAGIC = b"LMELAYER"
+VERSION = 1
+ALIGN = 64
+PREAMBLE = struct.Struct("<8sII")
+
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def encode_column(values):
+    """
+    将一列值编码为(码表, uint32编码), 元素、类名与键级中重复的值很多
+    """
+    table = {}
+    codes = np.fromiter((table.setdefault(value, len(table)) for value in values), dtype="uint32", count=len(values))
+    return list(table.keys()), codes
+
+
+class ContainsLoader:
+    """
+    延迟读取层文件中的`contains`记录, 只在第一次访问时读取并解析
+    """
+
+    def __init__(self, path, offset, length) -> None:
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __call__(self):
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            return json.loads(file.read(self.length).decode())
+
+
+def write_layer_file(path, molecule, contains=None, patch=None):
+    """
+    文件结构: 魔数、版本与头部长度, JSON头部(码表与各数组的偏移), 按64字节对齐的定长数组, 最后是JSON格式的`contains`
+    `patch`为EditableLayer对基础层(`molecule`)的修改, 以JSON保存在`contains`之后
+    """
+    arrays = {
+        "ids": np.frombuffer(b"".join(atom_id.bytes for atom_id in molecule.ids), dtype="uint8").reshape(-1, 16),
+        "positions": np.ascontiguousarray(molecule.positions, dtype="<f8"),
+        "bonds": np.ascontiguousarray(molecule.bonds, dtype="<i8"),
+    }
+    tables = {}
+    for column in ["elements", "class_names", "bond_orders"]:
+        tables[column], arrays[column] = encode_column(getattr(molecule, column))
+        arrays[column] = arrays[column].astype("<u4")
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        offset = aligned(offset + array.nbytes)
+    header = {"arrays": layout, "tables": tables}
+    blocks = b""
+    for name, value in [("contains", contains), ("patch", patch)]:
+        header[name] = None
+        if value is not None:
+            content = json.dumps(value).encode()
+            header[name] = [offset + len(blocks), len(content)]
+            blocks += content
+    header = json.dumps(header).encode()
+    data_start = aligned(PREAMBLE.size + len(header))
+    with open(path, "wb") as file:
+        file.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(data_start + layout[name][0])
+            file.write(array.tobytes())
+        file.seek(data_start + offset)
+        file.write(blocks)
+        file.truncate(data_start + offset + len(blocks))
+
+
+def read_layer_file(path):
+    """
+    返回(Molecule, contains, patch), 坐标与键直接映射到文件内容(只读), 多个进程打开同一文件时共享内存页
+    `contains`与`patch`为`ContainsLoader`, 没有记录时为`None`
+    """
+    with open(path, "rb") as file:
+        magic, version, header_length = PREAMBLE.unpack(file.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a layer file")
+        if version > VERSION:
+            raise ValueError(f"Layer file version {version} is not supported")
+        header = json.loads(file.read(header_length).decode())
+    data_start = aligned(PREAMBLE.size + header_length)
+    buffer = np.memmap(path, dtype="uint8", mode="r")
+
+    def array(name):
+        offset, dtype, shape = header["arrays"][name]
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        return buffer[start : start + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+
+    def column(name):
+        return object_array(header["tables"][name])[array(name)] if len(header["tables"][name]) != 0 else object_array([])
+
+    molecule = Molecule(
+        ids_from_bytes(array("ids").tobytes()),
+        column("elements"),
+        column("class_names"),
+        array("positions"),
+        array("bonds"),
+        column("bond_orders"),
+    )
+
+    def block(name):
+        location = header[name]
+        return ContainsLoader(path, data_start + location[0], location[1]) if location is not None else None
+
+    return molecule, block("contains"), block("patch")
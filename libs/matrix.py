@@ -1,3 +1,4 @@
+import re
 from scipy.spatial.transform import Rotation as R
 import numpy as np
 
@@ -17,3 +18,79 @@ def rotate_matrix(axis, angle):
     axis = np.array(axis, dtype="float64")
     axis = axis / np.linalg.norm(axis)
     return R.from_rotvec(axis * angle, degrees=True).as_matrix()
+
+
+def inverse_matrix():
+    return -1.0 * np.eye(3)
+
+
+def improper_rotate_matrix(axis, angle):
+    return np.matmul(mirror_matrix(np.array(axis, dtype="float64")), rotate_matrix(axis, angle))
+
+
+def group_closure(generators, eps, max_order=120):
+    """
+    由生成元矩阵生成闭合的矩阵群, 第一个元素为单位矩阵。
+    群阶超过`max_order`(点群最大为Ih的120)时说明生成元不构成有限点群, 抛出ValueError
+    """
+    group = [np.eye(3)]
+    queue = [np.eye(3)]
+    while len(queue) != 0:
+        current = queue.pop(0)
+        for generator in generators:
+            candidate = np.matmul(current, generator)
+            if any(np.abs(candidate - element).max() < eps for element in group):
+                continue
+            group.append(candidate)
+            queue.append(candidate)
+            if len(group) > max_order:
+                raise ValueError("Generators do not form a finite point group")
+    return np.array(group, dtype="float64")
+
+
+schoenflies_re = re.compile("^(?P<family>[CDS])(?P<n>[0-9]+)(?P<suffix>[hvd]?)$")
+
+
+def schoenflies_generators(symbol):
+    """
+    根据Schoenflies符号给出一组生成元矩阵, 主轴为z轴, 二次轴(D群)为x轴, σv为xz平面
+    """
+    golden = (1 + np.sqrt(5)) / 2
+    C3_111 = rotate_matrix([1, 1, 1], 120)
+    special = {
+        "C1": [],
+        "Ci": [inverse_matrix()],
+        "Cs": [mirror_matrix(np.array([0, 0, 1]))],
+        "T": [rotate_matrix([0, 0, 1], 180), C3_111],
+        "Td": [rotate_matrix([0, 0, 1], 180), C3_111, mirror_matrix(np.array([1, -1, 0]))],
+        "Th": [rotate_matrix([0, 0, 1], 180), C3_111, inverse_matrix()],
+        "O": [rotate_matrix([0, 0, 1], 90), C3_111],
+        "Oh": [rotate_matrix([0, 0, 1], 90), C3_111, inverse_matrix()],
+        "I": [rotate_matrix([0, 1, golden], 72), C3_111],
+        "Ih": [rotate_matrix([0, 1, golden], 72), C3_111, inverse_matrix()],
+    }
+    if symbol in special:
+        return special[symbol]
+    matched = schoenflies_re.match(symbol)
+    if matched is None:
+        raise ValueError(f"Unsupported point group {symbol}")
+    family, n, suffix = matched.group("family"), int(matched.group("n")), matched.group("suffix")
+    if n < 1 or (family == "S" and suffix != ""):
+        raise ValueError(f"Unsupported point group {symbol}")
+    z, x = [0, 0, 1], [1, 0, 0]
+    if family == "S":
+        return [improper_rotate_matrix(z, 360.0 / n)]
+    generators = [rotate_matrix(z, 360.0 / n)]
+    if family == "D":
+        generators.append(rotate_matrix(x, 180))
+    if suffix == "h":
+        generators.append(mirror_matrix(np.array(z, dtype="float64")))
+    if suffix == "v":
+        if family == "D":
+            raise ValueError(f"Unsupported point group {symbol}")
+        generators.append(mirror_matrix(np.array([0, 1, 0], dtype="float64")))
+    if suffix == "d":
+        if family == "C":
+            raise ValueError(f"Unsupported point group {symbol}")
+        generators.append(improper_rotate_matrix(z, 180.0 / n))
+    return generators
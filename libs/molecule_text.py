@@ -1,81 +1,222 @@
 
-from pydash import py_
+import io
+import re
+import numpy as np
 
-from libs.Atom import Atom
+from libs.Molecule import Molecule, new_ids, object_array
 
 def molecule_text(target) -> str:
-    output = ""
-    output += "atoms:\n"
-    atom_ids = py_.filter(
-        target.atom_ids, lambda atom_id: target.atoms[atom_id] is not None
+    molecule = target.molecule
+    buffer = io.StringIO()
+    buffer.write("atoms:\n")
+    for i, atom_id in enumerate(molecule.ids):
+        buffer.write(f"{i+1} {molecule.atom(atom_id)}\n")
+    buffer.write("bonds:\n")
+    for (a, b), order in zip(molecule.bonds, molecule.bond_orders):
+        buffer.write(f"{a + 1} {b + 1} {order}\n")
+    return buffer.getvalue()
+
+mol2_section_re = re.compile(r"^[ \t]*@<TRIPOS>(\w+)[ \t]*\r?$", re.M)
+
+def mol2_records(text):
+    """
+    按`@<TRIPOS>MOLECULE`切分为多个分子, 每个分子为`{段名: 数据行}`, 空行与注释行会被去掉
+    """
+    records = []
+    parts = mol2_section_re.split(text)
+    for section_name, body in zip(parts[1::2], parts[2::2]):
+        if section_name == "MOLECULE" or len(records) == 0:
+            records.append({})
+        records[-1][section_name] = [
+            line for line in body.splitlines() if line.strip() != "" and not line.lstrip().startswith("#")
+        ]
+    return records
+
+def mol2_rows(serials, referenced):
+    """
+    将键中引用的原子序号转换为行号
+    """
+    if np.array_equal(serials, np.arange(1, len(serials) + 1)):
+        rows = referenced - 1
+        if len(rows) != 0 and (rows.min() < 0 or rows.max() >= len(serials)):
+            raise KeyError("Bond refers to an atom not existed")
+        return rows
+    sorter = np.argsort(serials)
+    rows = sorter[np.clip(np.searchsorted(serials, referenced, sorter=sorter), 0, max(len(serials) - 1, 0))]
+    if len(referenced) != 0 and (len(serials) == 0 or not np.array_equal(serials[rows], referenced)):
+        raise KeyError("Bond refers to an atom not existed")
+    return rows
+
+def mol2_molecule(record):
+    atom_rows = [line.split() for line in record.get("ATOM", [])]
+    bond_rows = [line.split() for line in record.get("BOND", [])]
+    serials = np.array([row[0] for row in atom_rows], dtype="int64")
+    positions = np.array([row[2:5] for row in atom_rows], dtype="float64").reshape(-1, 3)
+    bonds = mol2_rows(serials, np.array([row[1:3] for row in bond_rows], dtype="int64").reshape(-1, 2))
+    bond_orders = object_array(row[3] for row in bond_rows)
+    # bonds are undirected, a repeated bond keeps its first position and the last order
+    _, first, inverse = np.unique(np.sort(bonds, axis=1), axis=0, return_index=True, return_inverse=True)
+    if len(first) != len(bonds):
+        inverse = inverse.reshape(-1)
+        last = np.zeros(len(first), dtype="int64")
+        np.maximum.at(last, inverse, np.arange(len(bonds)))
+        kept = np.sort(first)
+        bonds, bond_orders = bonds[kept], bond_orders[last[inverse[kept]]]
+    return Molecule(
+        new_ids(len(atom_rows)),
+        object_array(row[5].split(".")[0] for row in atom_rows),
+        object_array(row[1] for row in atom_rows),
+        positions,
+        bonds,
+        bond_orders,
     )
-    atoms = target.atoms
-    atoms = py_.map(atom_ids, lambda atom_id: atoms[atom_id])
-    for i, atom in enumerate(atoms):
-        output += f"{i+1} {atom}\n"
-
-    bond_ids = target.bond_ids
-    bonds = target.bonds
-    output += "bonds:\n"
-    for bond_id in bond_ids:
-        a_idx, b_idx = py_.find_index(
-            atom_ids, lambda atom_id: atom_id == bond_id.a
-        ), py_.find_index(atom_ids, lambda atom_id: atom_id == bond_id.b)
-        if -1 not in [a_idx, b_idx]:
-            output += f"{a_idx + 1} {b_idx + 1} {bonds[bond_id]}\n"
-
-    return output
-
-def mol2_get_section(lines, section_name):
-    section_start = py_.find_index(lines, lambda line: line == f"@<TRIPOS>{section_name}")
-    section_offset = py_.find_index(lines[section_start + 1:], lambda line: line.startswith("@<TRIPOS>")) 
-    if section_offset == -1:
-        return lines[section_start + 1:]
-    return lines[section_start + 1:section_start + 1 + section_offset]
-
-def mol2_to_atom(line):
-    [atom_id, atom_name, x, y, z, element] = py_.filter(line.split(" "), lambda item: item != "")[0:6]
-    atom = Atom(element.split(".")[0], [float(x), float(y), float(z)], atom_name)
-    return int(atom_id), atom
-
-def mol2_to_bond(line):
-    [a, b, order] = py_.filter(line.split(" "), lambda item: item != "")[1:4]
-    return int(a), int(b), order
-
-def atoms_bonds_from_mol2(text):
-    lineEnd = "\r\n" if "\r" in text else "\n"
-    lines = text.split(lineEnd)
-    
-    atoms_lines = py_.filter(mol2_get_section(lines, "ATOM"), lambda line: line != "" and not line.startswith("#"))
-    bonds_lines = py_.filter(mol2_get_section(lines, "BOND"), lambda line: line != "" and not line.startswith("#"))
-
-    return atoms_lines, bonds_lines    
+
+def molecules_from_mol2(text):
+    """
+    读取mol2文本中的全部分子, 返回`[(分子名, Molecule)]`
+    只读取ATOM与BOND段, 其他段(如SUBSTRUCTURE)以及原子行中的子结构、电荷列会被忽略
+    """
+    return [
+        (record["MOLECULE"][0].strip() if len(record.get("MOLECULE", [])) != 0 else "", mol2_molecule(record))
+        for record in mol2_records(text)
+    ]
+
+def molecule_from_mol2(text):
+    """
+    读取mol2文本中的第一个分子
+    """
+    molecules = molecules_from_mol2(text)
+    if len(molecules) == 0:
+        raise ValueError("No molecule found in mol2 text")
+    return molecules[0][1]
+
+def format_rows(row_format, columns):
+    """
+    一次格式化整张表: `columns`为等长的列, 按行交错后代入重复`len`次的`row_format`
+    """
+    count = len(columns[0]) if len(columns) != 0 else 0
+    if count == 0:
+        return ""
+    table = np.empty((count, len(columns)), dtype=object)
+    for i, column in enumerate(columns):
+        table[:, i] = column
+    return (row_format * count) % tuple(table.ravel().tolist())
+
+def mol2_atom_names(molecule):
+    """
+    有类名时为类名, 否则为元素符号加序号
+    """
+    serials = np.arange(1, len(molecule) + 1).astype(str).astype(object)
+    return np.where(molecule.class_names == "", molecule.elements + serials, molecule.class_names)
+
+def write_mol2(file, molecule, name = "unknown", mol_type = "SMALL", charge_type = "GASTEIGER", precision = 4):
+    file.write(f"@<TRIPOS>MOLECULE\n{name}\n{len(molecule)} {len(molecule.bonds)}\n{mol_type}\n{charge_type}\n")
+    file.write("\n@<TRIPOS>ATOM\n")
+    positions = molecule.positions
+    file.write(format_rows(
+        f"%d %s %.{precision}f %.{precision}f %.{precision}f %s\n",
+        [np.arange(1, len(molecule) + 1), mol2_atom_names(molecule), positions[:, 0], positions[:, 1], positions[:, 2], molecule.elements],
+    ))
+    file.write("\n@<TRIPOS>BOND\n")
+    file.write(format_rows(
+        "%d %d %d %s\n",
+        [np.arange(1, len(molecule.bonds) + 1), molecule.bonds[:, 0] + 1, molecule.bonds[:, 1] + 1, molecule.bond_orders],
+    ))
+    file.write("\n")
+
+def write_xyz(file, molecule, comment = "", precision = 6):
+    file.write(f"{len(molecule)}\n{comment}\n")
+    positions = molecule.positions
+    file.write(format_rows(
+        f"%s %.{precision}f %.{precision}f %.{precision}f\n",
+        [molecule.elements, positions[:, 0], positions[:, 1], positions[:, 2]],
+    ))
+
+# mol2 bond types to bond types of MDL molfile, unknown types are written as single bonds
+sdf_bond_types = {"1": 1, "2": 2, "3": 3, "ar": 4, "am": 1}
+
+def sdf_bond_type(order):
+    # numeric orders come from `set_bond` and workflows, 2.0 is the same bond type as "2"
+    if isinstance(order, (int, float, np.integer, np.floating)) and float(order).is_integer():
+        order = int(order)
+    return sdf_bond_types.get(str(order).lower(), 1)
+
+def write_sdf(file, molecule, name = "unknown", precision = 4):
+    """
+    写出一条V2000格式的SDF记录, 以`$$$$`结尾
+    """
+    if len(molecule) > 999 or len(molecule.bonds) > 999:
+        raise ValueError("V2000 molfile supports at most 999 atoms and 999 bonds")
+    file.write(f"{name}\n  LME\n\n{len(molecule):3d}{len(molecule.bonds):3d}  0  0  0  0  0  0  0  0999 V2000\n")
+    positions = molecule.positions
+    file.write(format_rows(
+        f"%10.{precision}f%10.{precision}f%10.{precision}f %-3s 0  0  0  0  0  0  0  0  0  0  0  0\n",
+        [positions[:, 0], positions[:, 1], positions[:, 2], molecule.elements],
+    ))
+    file.write(format_rows(
+        "%3d%3d%3d  0  0  0  0\n",
+        [molecule.bonds[:, 0] + 1, molecule.bonds[:, 1] + 1, [sdf_bond_type(order) for order in molecule.bond_orders]],
+    ))
+    file.write("M  END\n$$$$\n")
+
+writers = {"mol2": write_mol2, "xyz": write_xyz, "sdf": write_sdf}
+
+sdf_bond_orders = {1: "1", 2: "2", 3: "3", 4: "ar"}
+
+def sdf_molecule(lines):
+    counts = lines[3]
+    atoms_count, bonds_count = int(counts[0:3]), int(counts[3:6])
+    atom_lines = lines[4:4 + atoms_count]
+    bond_lines = lines[4 + atoms_count:4 + atoms_count + bonds_count]
+    positions = np.array(
+        [[line[0:10], line[10:20], line[20:30]] for line in atom_lines], dtype="float64"
+    ).reshape(-1, 3)
+    bonds = np.array([[line[0:3], line[3:6]] for line in bond_lines], dtype="int64").reshape(-1, 2) - 1
+    return Molecule(
+        new_ids(atoms_count),
+        object_array(line[31:34].strip() for line in atom_lines),
+        None,
+        positions,
+        bonds,
+        object_array(sdf_bond_orders.get(int(line[6:9]), "1") for line in bond_lines),
+    )
+
+def molecules_from_sdf(text):
+    """
+    读取V2000格式SDF中的全部记录, 返回`[(分子名, Molecule)]`, SDF中没有原子名, 类名均为空
+    """
+    records = [record for record in re.split(r"^\$\$\$\$[ \t]*\r?$", text, flags=re.M) if record.strip() != ""]
+    molecules = []
+    for record in records:
+        lines = record.lstrip("\r\n").splitlines()
+        molecules.append((lines[0].strip(), sdf_molecule(lines)))
+    return molecules
+
+def molecule_to_text(molecule, format = "mol2", **options):
+    buffer = io.StringIO()
+    writers[format](buffer, molecule, **options)
+    return buffer.getvalue()
 
 def atoms_bonds_to_mol2(atoms, bonds, name = "unknown", mol_type = "SMALL", charge_type = "GASTEIGER"):
-    content = "@<TRIPOS>MOLECULE\n"
-    content += f"{name}\n"
-    content += f"{len(atoms)} {len(bonds)}\n"
-    content += f"{mol_type}\n{charge_type}\n"
-    
-    content += "\n@<TRIPOS>ATOM\n"
-    atom_ids = atoms.keys()
-    for i, atom_id in enumerate(atom_ids):
-        atom = atoms[atom_id]
-        [x, y, z] = atom.position
-        if atom.class_name == "":
-            content += f"{i + 1} {atom.element}{i+1} {x} {y} {z} {atom.element}\n"
-        else:
-            content += f"{i + 1} {atom.class_name} {x} {y} {z} {atom.element}\n"
-
-    atoms_id_uuid = {
-        atom_id: i + 1 for i, atom_id in enumerate(atom_ids)
-    }
-
-    content += "\n@<TRIPOS>BOND\n"
-    for i, bond in enumerate(bonds.keys()):
-        a, b = atoms_id_uuid[bond.a], atoms_id_uuid[bond.b]
-        content += f"{i + 1} {a} {b} {bonds[bond]}\n"
-
-    content += "\n"
-
-    return content
\ No newline at end of file
+    return molecule_to_text(
+        Molecule.from_atoms_bonds(atoms, bonds), "mol2", name=name, mol_type=mol_type, charge_type=charge_type
+    )
+
+
+if __name__ == "__main__":
+    # check the readers on the example template: python -m libs.molecule_text
+    with open("example_data/template.mol2", newline="") as file:
+        text = file.read().replace("\r\n", "\n")
+    molecule = molecule_from_mol2(text)
+    # mol2 files saved on Windows end lines with CRLF
+    crlf = molecule_from_mol2(text.replace("\n", "\r\n"))
+    assert len(crlf) == len(molecule) and len(crlf.bonds) == len(molecule.bonds)
+    assert list(crlf.class_names) == list(molecule.class_names)
+    assert np.array_equal(crlf.positions, molecule.positions) and list(crlf.bond_orders) == list(molecule.bond_orders)
+    print(f"mol2: {len(molecule)} atoms, {len(molecule.bonds)} bonds, OK")
+
+    # numeric bond orders keep their bond types in SDF
+    orders = object_array([2.0, 3, "ar", np.float64(1.0)] + list(molecule.bond_orders[4:]))
+    [(_, sdf)] = molecules_from_sdf(molecule_to_text(molecule.with_bonds(molecule.bonds, orders), "sdf"))
+    assert list(sdf.bond_orders[:4]) == ["2", "3", "ar", "1"]
+    print(f"sdf: {len(sdf)} atoms, {len(sdf.bonds)} bonds, OK")
@@ -25,4 +25,7 @@ class ClampRisky:
 
 workflow = Workflow(workflow_data, runners=default_runners | {"risky": (ClampRisky, False)})
 
+if "--resume" in argv[2:]:
+    workflow.resume()
+
 workflow.run()
\ No newline at end of file
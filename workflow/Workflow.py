@@ -2,9 +2,13 @@ import yaml
 from fs.osfs import OSFS
 from posixpath import isabs, join, relpath
 from datetime import datetime
-from layers.EditableLayer import EditableLayer
+from layers.StaticLayer import StaticLayer
+from libs.molecule_text import molecule_from_mol2
 from pydash import py_
 from workflow.runners import default_runners
+from workflow.executors import JobExecutor, iter_runner
+from workflow.cache import StageCache
+from workflow.checkpoint import Checkpoint
 
 class Workflow:
     def __init__(self, config, runners = default_runners) -> None:
@@ -19,12 +23,39 @@ class Workflow:
         template_path = join(*config["template"])
         template_path = relpath(template_path, rootDirectory) if isabs(template_path) else template_path
         self.rootDirectory = OSFS(rootDirectory)
-        self.template = EditableLayer.from_mol2(self.rootDirectory.readtext(template_path)).to_static_layer()
+        self.template = StaticLayer.from_molecule(molecule_from_mol2(self.rootDirectory.readtext(template_path)))
         self.generated = [(self.template, {})]
         self.jobs = config["jobs"]
         self.current_step = 0
         self.runners = runners
+        self.__check_archives()
+        self.executor = JobExecutor(config)
+        self.streaming = config.get("streaming", False)
+        cache = config.get("cache")
+        self.cache = StageCache(rootDirectory, join(*cache)) if cache is not None else None
+        self.stage_key = StageCache.template_key(self.template) if self.cache is not None else None
+        checkpoint = config.get("checkpoint")
+        self.checkpoint = Checkpoint(
+            self.rootDirectory, join(*checkpoint), Checkpoint.fingerprint_of(self.template, self.jobs)
+        ) if checkpoint is not None else None
+        self.checkpoint_every = config.get("checkpoint_every")
+        # (items of `generated` done, their products) of the job in progress
+        self.progress = None
     
+    def __check_archives(self):
+        """
+        每个job开始时会清空它追加的文件, 多个job追加到同一文件时后面的job会删除前面的结果, 因此不允许
+        """
+        archives = {}
+        for job in self.jobs:
+            (runner_builder, _) = self.runners[job["use"]]
+            path = runner_builder.archive_path(job["with"], self.metas) if hasattr(runner_builder, "archive_path") else None
+            if path is None:
+                continue
+            if path in archives:
+                raise ValueError(f"Jobs {archives[path]} and {job['name']} append to the same archive {path}")
+            archives[path] = job["name"]
+
     def run_step(self):
         if(self.current_step >= len(self.jobs)):
             return False
@@ -33,27 +64,113 @@ class Workflow:
         print(f"Enter job {self.current_step}: {current_task['name']}")
         start_at = datetime.now()
         (runner_builder, need_flat) = self.runners[current_task["use"]]
-        runner = runner_builder(current_task["with"], self.metas)
-        def full_runner(working_item):
-            model, names = working_item
+        cacheable, stage_key = False, None
+        if self.cache is not None:
+            stage_key = StageCache.stage_key(self.stage_key, current_task, runner_builder, self.metas)
+            cacheable = StageCache.cacheable(runner_builder)
+        if cacheable and stage_key in self.cache:
+            self.generated = self.cache.load(stage_key)
+            self.progress = None
+            print(f"Load job {self.current_step}: {current_task['name']} from cache")
+        else:
+            processed = self.__run_job(current_task, runner_builder, need_flat)
             if need_flat:
-                products = runner(model, names)
-                products = [(product, names | {current_task["name"]: tag}) for product, tag in products]
-                return products
-            else:
-                model, tag = runner(model, names)
-                return (model, names | {current_task["name"]: tag})
-        processed = py_.map(self.generated, full_runner)
-        if need_flat:
-            processed = py_.flatten(processed)
-        self.generated = processed
+                processed = py_.flatten(processed)
+            self.generated = processed
+            if cacheable:
+                self.cache.store(stage_key, self.generated)
+        self.stage_key = stage_key
+        self.__save_checkpoint(self.current_step)
         print(f"Exit job {self.current_step}: {current_task['name']}, uses {datetime.now() - start_at}")
         return True
 
+    def __run_job(self, job, runner_builder, need_flat):
+        """
+        设置了`checkpoint_every`时每处理这么多项保存一次检查点, 恢复时跳过已完成的项
+        """
+        executor = self.executor.with_job(job)
+        done, processed = self.progress if self.progress is not None else (0, [])
+        if done == 0 and hasattr(runner_builder, "reset"):
+            runner_builder.reset(job["with"], self.metas)
+        batch = self.checkpoint_every if self.checkpoint is not None and self.checkpoint_every else len(self.generated)
+        while done < len(self.generated):
+            items = self.generated[done:done + batch]
+            processed += executor.map(
+                runner_builder, job["with"], self.metas, job["name"], need_flat, items
+            )
+            done += len(items)
+            if done < len(self.generated):
+                self.progress = (done, processed)
+                self.__save_checkpoint(self.current_step - 1)
+        self.progress = None
+        return processed
+
+    def __save_checkpoint(self, step):
+        if self.checkpoint is None:
+            return
+        self.checkpoint.save({
+            "current_step": step, "generated": self.generated,
+            "progress": self.progress, "stage_key": self.stage_key,
+        })
+
+    def resume(self):
+        """
+        从检查点继续: 跳过已完成的job, 正在执行的job从最后保存的一项之后继续
+        检查点不存在时从头开始, 返回是否从检查点恢复
+        """
+        if self.checkpoint is None:
+            raise ValueError("No checkpoint configured in workflow")
+        if not self.checkpoint.exists():
+            return False
+        state = self.checkpoint.load()
+        self.current_step = state["current_step"]
+        self.generated = state["generated"]
+        self.progress = state["progress"]
+        self.stage_key = state["stage_key"]
+        done = self.progress[0] if self.progress is not None else 0
+        print(f"Resume from checkpoint: {self.current_step} jobs finished, {done} of {len(self.generated)} items of next job done")
+        return True
+
+    def stream(self):
+        """
+        深度优先地执行剩余的全部job, 每个组合在生成后立即流经后续所有job, 逐个产生最终结果
+        同一时刻只保留从模板到当前组合的一条路径, 内存占用与组合总数无关
+        """
+        first_step = self.current_step
+        runners = {}
+
+        def runner_of(step):
+            if step not in runners:
+                job = self.jobs[step]
+                (runner_builder, need_flat) = self.runners[job["use"]]
+                if hasattr(runner_builder, "reset"):
+                    runner_builder.reset(job["with"], self.metas)
+                runners[step] = (runner_builder(job["with"], self.metas), need_flat)
+            return runners[step]
+
+        def descend(step, working_item):
+            if step == len(self.jobs):
+                yield working_item
+                return
+            runner, need_flat = runner_of(step)
+            for product in iter_runner(runner, self.jobs[step]["name"], need_flat, working_item):
+                yield from descend(step + 1, product)
+
+        generated, self.generated = self.generated, []
+        self.current_step = len(self.jobs)
+        for working_item in generated:
+            yield from descend(first_step, working_item)
+
     def run(self):
         start_at = datetime.now()
         print(f"Task start at {start_at}")
-        while(True):
-            if not self.run_step():
-                break
+        if self.streaming:
+            count = 0
+            for _, names in self.stream():
+                count += 1
+                print(f"Finished {count}: {names}")
+        else:
+            while(True):
+                if not self.run_step():
+                    break
         print(f"All jobs finished. Used {datetime.now() - start_at}")
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import pickle
+from fs.osfs import OSFS
+
+
+def digest(*parts):
+    content = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            content.update(part)
+        else:
+            content.update(json.dumps(part, sort_keys=True, default=str).encode())
+        content.update(b"\0")
+    return content.hexdigest()
+
+
+def dump(directory, filename, content):
+    """
+    以pickle保存`content`, 先写入临时文件再重命名, 中断时不会留下不完整的文件
+    """
+    directory.writebytes(f"{filename}.tmp", pickle.dumps(content, pickle.HIGHEST_PROTOCOL))
+    directory.move(f"{filename}.tmp", filename, overwrite=True)
+
+
+def load(directory, filename):
+    return pickle.loads(directory.readbytes(filename))
+
+
+class StageCache:
+    """
+    以内容哈希为键的workflow阶段结果缓存, 每个阶段的结果(`Workflow.generated`)保存为一个pickle文件
+
+    阶段的键由上一阶段的键、job的`use`与`with`以及runner声明的额外输入(如取代基文件内容)计算得到,
+    第一个阶段之前的键为模板内容的哈希, 因此任一输入改变时, 该阶段及其后所有阶段的键都会改变。
+    """
+
+    def __init__(self, rootDirectory, directory) -> None:
+        self.directory = OSFS(rootDirectory).makedirs(directory, recreate=True)
+
+    @staticmethod
+    def template_key(template):
+        return digest("template", template.molecule.digest())
+
+    @staticmethod
+    def stage_key(previous_key, job, runner_builder, metas):
+        extra = runner_builder.cache_inputs(job["with"], metas) if hasattr(runner_builder, "cache_inputs") else None
+        return digest(previous_key, job["name"], job["use"], job["with"], extra)
+
+    @staticmethod
+    def cacheable(runner_builder):
+        """
+        只有声明了`cacheable = True`(没有副作用)的runner的结果会被缓存
+        """
+        return getattr(runner_builder, "cacheable", False)
+
+    def __filename(self, key):
+        return f"{key}.pkl"
+
+    def __contains__(self, key) -> bool:
+        return self.directory.exists(self.__filename(key))
+
+    def load(self, key):
+        return load(self.directory, self.__filename(key))
+
+    def store(self, key, generated):
+        dump(self.directory, self.__filename(key), generated)
@@ -0,0 +1,34 @@
+from posixpath import dirname
+from workflow.cache import digest, dump, load
+
+
+class Checkpoint:
+    """
+    workflow的检查点文件, 记录已完成的job数、当前的`generated`以及正在执行的job中已完成的部分
+
+    文件中保存了模板与jobs配置的哈希, 配置改变后不能从旧的检查点恢复。
+    """
+
+    def __init__(self, rootDirectory, path, fingerprint) -> None:
+        self.rootDirectory = rootDirectory
+        self.path = path
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def fingerprint_of(template, jobs):
+        return digest(template.molecule.digest(), jobs)
+
+    def exists(self) -> bool:
+        return self.rootDirectory.exists(self.path)
+
+    def save(self, state):
+        target_dir = dirname(self.path)
+        if target_dir != "" and not self.rootDirectory.exists(target_dir):
+            self.rootDirectory.makedirs(target_dir, recreate=True)
+        dump(self.rootDirectory, self.path, {"fingerprint": self.fingerprint} | state)
+
+    def load(self):
+        state = load(self.rootDirectory, self.path)
+        if state.pop("fingerprint") != self.fingerprint:
+            raise ValueError(f"Checkpoint {self.path} was created by a different template or jobs")
+        return state
@@ -0,0 +1,95 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+import os
+
+EXECUTORS = ["serial", "thread", "process"]
+
+
+def iter_runner(runner, job_name, need_flat, working_item):
+    """
+    逐个产生runner处理`working_item`得到的结果, runner返回生成器时不会一次性生成全部结果
+    标签为dict时其中的每一项都会加入标签, job本身的标签为各项以`.`连接
+    """
+    model, names = working_item
+    if need_flat:
+        for product, tag in runner(model, names):
+            yield (product, with_tag(names, job_name, tag))
+    else:
+        model, tag = runner(model, names)
+        yield (model, with_tag(names, job_name, tag))
+
+
+def with_tag(names, job_name, tag):
+    if isinstance(tag, dict):
+        return names | {job_name: ".".join(tag.values())} | tag
+    return names | {job_name: tag}
+
+
+def apply_runner(runner, job_name, need_flat, working_item):
+    products = list(iter_runner(runner, job_name, need_flat, working_item))
+    return products if need_flat else products[0]
+
+
+# Each worker process builds the runner of current job once in `init_worker`
+worker_job = None
+
+
+def init_worker(runner_builder, options, metas, job_name, need_flat):
+    global worker_job
+    worker_job = (runner_builder(options, metas), job_name, need_flat)
+
+
+def run_in_worker(working_item):
+    runner, job_name, need_flat = worker_job
+    return apply_runner(runner, job_name, need_flat, working_item)
+
+
+class JobExecutor:
+    """
+    按配置执行一个job: 串行(serial)、线程池(thread)或进程池(process)
+
+    输出顺序与输入顺序一致。进程池模式下每个进程只构建一次runner, 各项按`chunksize`分块发送给进程。
+    """
+
+    def __init__(self, config=None) -> None:
+        config = config if config is not None else {}
+        self.type = config.get("executor", "serial")
+        if self.type not in EXECUTORS:
+            raise ValueError(f"Unknown executor {self.type}, should be one of {EXECUTORS}")
+        self.workers = config.get("workers") or os.cpu_count()
+        self.chunksize = config.get("chunksize")
+
+    def with_job(self, job):
+        """
+        job中的`executor`, `workers`和`chunksize`会覆盖全局配置
+        """
+        return JobExecutor(
+            {
+                "executor": job.get("executor", self.type),
+                "workers": job.get("workers", self.workers),
+                "chunksize": job.get("chunksize", self.chunksize),
+            }
+        )
+
+    def __chunksize(self, count):
+        if self.chunksize is not None:
+            return self.chunksize
+        return max(1, count // (self.workers * 4))
+
+    def map(self, runner_builder, options, metas, job_name, need_flat, items):
+        # runners could prepare shared resources in the main process, before workers are forked
+        if hasattr(runner_builder, "prepare"):
+            runner_builder.prepare(options, metas)
+        if self.type == "process" and len(items) > 1:
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=get_context("fork") if os.name != "nt" else None,
+                initializer=init_worker,
+                initargs=(runner_builder, options, metas, job_name, need_flat),
+            ) as executor:
+                return list(executor.map(run_in_worker, items, chunksize=self.__chunksize(len(items))))
+        runner = runner_builder(options, metas)
+        if self.type == "thread" and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(lambda item: apply_runner(runner, job_name, need_flat, item), items))
+        return [apply_runner(runner, job_name, need_flat, item) for item in items]
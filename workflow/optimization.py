@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from posixpath import join, dirname
+import json
+import numpy as np
+from openbabel import openbabel
+from openbabel import pybel
+from libs.molecule_text import molecule_to_text, mol2_atom_names
+
+
+def atom_names(molecule):
+    """
+    与`write_mol2`写出的原子名一致: 有类名时为类名, 否则为元素符号加序号
+    """
+    return list(mol2_atom_names(molecule))
+
+
+class ForceFieldOptimizer:
+    """
+    力场优化器
+
+    拓扑(元素、键与冻结原子)相同的结构共享同一份力场设置, 只替换坐标; 每个进程中缓存最近使用的`cache_size`种拓扑。
+    优化在能量变化小于`econv`或达到`steps`步时结束。
+    """
+
+    def __init__(self, forcefield="UFF", steps=500, econv=1e-6, cache_size=8) -> None:
+        self.forcefield = forcefield
+        self.steps = steps
+        self.econv = econv
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @staticmethod
+    def topology(molecule, frozen):
+        return (
+            tuple(molecule.elements),
+            molecule.bonds.tobytes(),
+            tuple(str(order) for order in molecule.bond_orders),
+            tuple(frozen),
+        )
+
+    def __setup(self, molecule, frozen):
+        key = ForceFieldOptimizer.topology(molecule, frozen)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key], True
+        mol2 = molecule_to_text(molecule, "mol2")
+        obmol = pybel.readstring("mol2", mol2).OBMol
+        constraints = openbabel.OBFFConstraints()
+        for row in frozen:
+            constraints.AddAtomConstraint(int(row) + 1)
+        ff = openbabel.OBForceField.FindForceField(self.forcefield).MakeNewInstance()
+        if not ff.Setup(obmol, constraints):
+            raise RuntimeError(f"Failed to setup force field {self.forcefield}")
+        self.cache[key] = (ff, obmol)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return (ff, obmol), False
+
+    def optimize(self, molecule, frozen=()):
+        """
+        返回(优化后的OBMol, 优化后的(N,3)坐标, 优化报告)
+        返回的OBMol在下一次调用前有效
+        """
+        (ff, obmol), reused = self.__setup(molecule, frozen)
+        if reused:
+            for i, (x, y, z) in enumerate(molecule.positions):
+                obmol.GetAtom(i + 1).SetVector(float(x), float(y), float(z))
+            ff.SetCoordinates(obmol)
+        initial_energy = ff.Energy()
+        # keep a margin in the step budget, so a False from TakeNSteps always means converged
+        ff.ConjugateGradientsInitialize(self.steps + 10, self.econv)
+        steps, converged = 0, False
+        while steps < self.steps:
+            chunk = min(10, self.steps - steps)
+            steps += chunk
+            if not ff.ConjugateGradientsTakeNSteps(chunk):
+                converged = True
+                break
+        ff.GetCoordinates(obmol)
+        positions = np.array(
+            [
+                [obmol.GetAtom(i + 1).GetX(), obmol.GetAtom(i + 1).GetY(), obmol.GetAtom(i + 1).GetZ()]
+                for i in range(len(molecule))
+            ],
+            dtype="float64",
+        )
+        report = {
+            "forcefield": self.forcefield,
+            "unit": ff.GetUnit(),
+            "initial_energy": initial_energy,
+            "energy": ff.Energy(),
+            "steps": steps,
+            "converged": converged,
+            "reused_setup": reused,
+        }
+        return obmol, positions, report
+
+
+class OptimizationStage:
+    """
+    由workflow中`clean`/`optimize`的配置构建, 供`Output`与`Optimize`共用
+
+    配置项: forcefield(默认UFF), steps(最大步数), econv(收敛判据, 默认1e-6), freeze(冻结的原子名),
+    rules(只优化标签匹配的结构, 为空时优化全部), report(以JSON Lines格式记录每个结构能量的文件路径)
+    """
+
+    def __init__(self, options, rootDirectory) -> None:
+        self.optimizer = ForceFieldOptimizer(
+            options.get("forcefield", "UFF"), options["steps"], options.get("econv", 1e-6)
+        )
+        self.freeze = options.get("freeze") or []
+        self.rules = options.get("rules") or []
+        report = options.get("report")
+        self.report = join(*report) if report is not None else None
+        self.rootDirectory = rootDirectory
+
+    def matches(self, tags):
+        if len(self.rules) == 0:
+            return True
+        return any(tags.get(tag) == value for [tag, value] in self.rules)
+
+    def frozen_rows(self, molecule):
+        return [i for i, name in enumerate(atom_names(molecule)) if name in self.freeze]
+
+    def __write_report(self, tags, report):
+        line = json.dumps({"tags": tags} | report)
+        if self.report is None:
+            print(line)
+            return
+        target_dir = dirname(self.report)
+        if target_dir != "" and not self.rootDirectory.exists(target_dir):
+            self.rootDirectory.makedirs(target_dir, recreate=True)
+        self.rootDirectory.appendtext(self.report, line + "\n")
+
+    def __call__(self, molecule, tags):
+        obmol, positions, report = self.optimizer.optimize(molecule, self.frozen_rows(molecule))
+        self.__write_report(tags, report)
+        return obmol, positions, report
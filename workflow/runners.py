@@ -1,79 +1,137 @@
+import json
 from typing import Any
 from pydash import py_
 from fs.osfs import OSFS
-from layers.EditableLayer import Substitute, EditableLayer
-from libs.molecule_text import atoms_bonds_to_mol2
-from posixpath import join, isabs, relpath, dirname
-from openbabel import openbabel
+from layers.EditableLayer import EditableLayer
+from libs.molecule_text import writers
+from libs.archive import StructureArchive
+from posixpath import join, isabs, relpath, dirname, splitext, normpath
 from openbabel import pybel
-import re
+from layers.StaticLayer import StaticLayer
+from layers.DiffCombinator import DiffCombinator, SiteDiff
+from workflow.optimization import OptimizationStage
+from workflow.substitutes import SubstituteLibrary
 
-atom_section_re = re.compile("@<TRIPOS>ATOM\n((.*\n)*)\n@")
+# Runners with `cacheable = True` have no side effects, their results could be loaded from the stage cache.
+# `cache_inputs(options, metas)` returns contents of the files a runner reads, which are part of the cache key.
+# `prepare(options, metas)` runs in the main process before a job starts.
+# `reset(options, metas)` runs in the main process once per run when a job starts from its first item,
+# it is skipped when the job is resumed from a checkpoint in the middle.
+# `archive_path(options, metas)` returns the file a runner appends to (or None), no two jobs may share it.
 
 class AddSubsititute:
+    cacheable = True
+
     def __init__(self, options, metas) -> None:
         self.replace = options["replace"]
-        self.substitutes_lib = py_.map(metas["substitutes"], lambda libpath: join(metas["rootDirectory"], libpath)) + [join(dirname(__file__.replace("\\", "/")), "..", "Substitutes")]
-        self.substitutes_lib = [OSFS(directory) for directory in self.substitutes_lib]
-        self.substitutes = options["substitutes"]
-        if self.substitutes == "all":
-            self.substitutes = self.__all_substitutes()
-
-
-    def __all_substitutes(self):
-        return (
-            py_
-                .chain(self.substitutes_lib)
-                .map(lambda directory: directory.listdir("."))
-                .flatten()
-                .filter(lambda filename: filename.endswith(".mol2"))
-                .uniq()
-                .map(lambda filename: filename[0:-5])
-                .value()
+        self.library = SubstituteLibrary.shared(AddSubsititute.directories(metas))
+        self.substitutes = AddSubsititute.entries(options, self.library)
+
+    @staticmethod
+    def directories(metas):
+        return py_.map(metas["substitutes"], lambda libpath: join(metas["rootDirectory"], libpath)) + [join(dirname(__file__.replace("\\", "/")), "..", "Substitutes")]
+
+    @staticmethod
+    def entries(options, library):
+        if options["substitutes"] == "all":
+            return library.names()
+        return options["substitutes"]
+
+    @staticmethod
+    def entry_names(sub_entry):
+        """
+        返回(标签, 取代基名)
+        """
+        if type(sub_entry) == str:
+            return sub_entry, sub_entry
+        return sub_entry["name"], sub_entry["substitute"]
+
+    @staticmethod
+    def prepare(options, metas):
+        # parse the substitutes before workers are forked, so they are shared by all workers
+        library = SubstituteLibrary.shared(AddSubsititute.directories(metas))
+        library.load(
+            AddSubsititute.entry_names(sub_entry)[1] for sub_entry in AddSubsititute.entries(options, library)
         )
-    
+
+    @staticmethod
+    def cache_inputs(options, metas):
+        return SubstituteLibrary.shared(AddSubsititute.directories(metas)).digest()
+
+    @staticmethod
+    def substitute(editable, substitute, replace):
+        indexes = py_.map(replace, lambda names: py_.map(names, lambda name: editable.find_with_classname(name)[0]))
+        with editable.batch():
+            for [entry_idx,center_idx] in indexes:
+                editable.add_substitute(substitute, center_idx, entry_idx)
+
     def load_substitute(self, substitute_name):
-        target_filename = f"{substitute_name}.mol2"
-        for directory in self.substitutes_lib:
-            try:
-                mol2 = directory.readtext(target_filename)
-                return Substitute.from_mol2(mol2)        
-            except Exception:
-                pass
-        raise FileNotFoundError(f"No {target_filename} found in given directories")
+        return self.library.get(substitute_name)
     
     def __call__(self, target, names) -> Any:
         def generate_for_subsitite(sub_entry):
             editable = EditableLayer(target)
-            indexes = py_.map(self.replace, lambda names: py_.map(names, lambda name: editable.find_with_classname(name)[0]))
-            if type(sub_entry) == str:
-                tag_name = sub_entry
-                sub_name = sub_entry
-            else:
-                tag_name = sub_entry["name"]
-                sub_name = sub_entry["substitute"]
-            substitute = self.load_substitute(sub_name)
-            for [entry_idx,center_idx] in indexes:
-                editable.add_substitute(substitute, center_idx, entry_idx)
+            tag_name, sub_name = AddSubsititute.entry_names(sub_entry)
+            AddSubsititute.substitute(editable, self.load_substitute(sub_name), self.replace)
             return editable.to_static_layer(), tag_name
-        return [generate_for_subsitite(sub_entry) for sub_entry in self.substitutes]
+        return (generate_for_subsitite(sub_entry) for sub_entry in self.substitutes)
+
+class CombineSubstitutes:
+    """
+    一次完成多个位点的取代: 每个位点的每个取代基只相对输入结构计算一次修改, 再组合出所有位点取代基的组合
+    标签为`{位点名: 取代基标签}`
+    """
+    cacheable = True
+
+    def __init__(self, options, metas) -> None:
+        self.library = SubstituteLibrary.shared(AddSubsititute.directories(metas))
+        self.sites = [
+            (site["name"], site["replace"], AddSubsititute.entries(site, self.library))
+            for site in options["sites"]
+        ]
+
+    @staticmethod
+    def prepare(options, metas):
+        for site in options["sites"]:
+            AddSubsititute.prepare(site, metas)
+
+    @staticmethod
+    def cache_inputs(options, metas):
+        return AddSubsititute.cache_inputs(options, metas)
+
+    def __call__(self, target, names) -> Any:
+        combinator = DiffCombinator(target)
+        for site_name, replace, sub_entries in self.sites:
+            options = []
+            for sub_entry in sub_entries:
+                tag_name, sub_name = AddSubsititute.entry_names(sub_entry)
+                editable = EditableLayer(target)
+                AddSubsititute.substitute(editable, self.library.get(sub_name), replace)
+                options.append((tag_name, SiteDiff(target, editable)))
+            combinator.add_site(site_name, options)
+        return iter(combinator)
 
 class AtomModify:
+    cacheable = True
+
     def __init__(self, options, metas) -> None:
         self.tasks = options
 
     def __call__(self, target, names) -> Any:
         editable = EditableLayer(target)
-        for task in self.tasks:
-            editable.deselect_all()
-            editable.select(editable.find_with_classname(task["select"]))
-            if "element" in task:
-                editable.set_element_selected(task["element"])
-            if "translation" in task:
-                editable.translation_selected(task["translation"])
+        with editable.batch():
+            for task in self.tasks:
+                editable.deselect_all()
+                editable.select(editable.find_with_classname(task["select"]))
+                if "element" in task:
+                    editable.set_element_selected(task["element"])
+                if "translation" in task:
+                    editable.translation_selected(task["translation"])
         return editable.to_static_layer(), ""
 
 class BondModify:
+    cacheable = True
+
     def __init__(self, options, metas) -> None:
         self.tasks = options
 
@@ -81,17 +139,17 @@ class BondModify:
         editable = EditableLayer(target)
         connects = [[editable.find_with_classname(n1)[0], editable.find_with_classname(n2)[0], bond_type] for [n1, n2, bond_type] in self.tasks]
         
-        for [a, b, bond] in connects:
-            editable.set_bond(a, b, bond)
+        with editable.batch():
+            for [a, b, bond] in connects:
+                editable.set_bond(a, b, bond)
         
         return editable.to_static_layer(), ""
 
 class ImportStructure:
+    cacheable = True
+
     def __init__(self, options, metas) -> Any:
-        rootDirectory = metas["rootDirectory"]
-        targetPath = join(*options["filepath"])
-        targetPath = relpath(targetPath, rootDirectory) if isabs(rootDirectory) else targetPath
-        editable = EditableLayer.from_mol2(OSFS(rootDirectory).readtext(targetPath))
+        editable = EditableLayer.from_mol2(ImportStructure.read(options, metas).decode())
         self.atoms = editable.atoms
         self.bonds = editable.bonds
         self.rotation = options.get("rotation")
@@ -99,110 +157,130 @@ class ImportStructure:
 
     def __call__(self, target, names) -> Any:
         editable = EditableLayer(target)
-        editable.import_atoms_bonds(self.atoms, self.bonds)
-        if self.rotation is not None and self.rotation is not False:
-            editable.rotation_selected(self.rotation["axis"], self.rotation["center"], self.rotation["angle"])
+        with editable.batch():
+            editable.import_atoms_bonds(self.atoms, self.bonds)
+            if self.rotation is not None and self.rotation is not False:
+                editable.rotation_selected(self.rotation["axis"], self.rotation["center"], self.rotation["angle"])
 
-        if self.translation is not None and self.translation is not False:
-            editable.translation_selected(self.translation)
+            if self.translation is not None and self.translation is not False:
+                editable.translation_selected(self.translation)
 
         return editable.to_static_layer(), ""
 
+    @staticmethod
+    def read(options, metas):
+        rootDirectory = metas["rootDirectory"]
+        targetPath = join(*options["filepath"])
+        targetPath = relpath(targetPath, rootDirectory) if isabs(rootDirectory) else targetPath
+        return OSFS(rootDirectory).readbytes(targetPath)
+
+    @staticmethod
+    def cache_inputs(options, metas):
+        return ImportStructure.read(options, metas)
+
 def debug_output(a):
     print(a)
     return a
 
+class Optimize:
+    cacheable = True
+
+    def __init__(self, options, metas) -> None:
+        self.stage = OptimizationStage(options, OSFS(metas["rootDirectory"]))
+
+    def __call__(self, item, names) -> Any:
+        if not self.stage.matches(names):
+            return item, ""
+        molecule = item.molecule
+        _, positions, report = self.stage(molecule, names)
+        optimized = StaticLayer.from_molecule(molecule.with_positions(positions))
+        return optimized, "converged" if report["converged"] else "unconverged"
+
 class Output:
     def __init__(self, options, metas) -> None:
         self.rootDirectory = OSFS(metas["rootDirectory"])
+        self.clean = options.get("clean")
+        self.stage = OptimizationStage(self.clean, self.rootDirectory) if self.clean is not None else None
+        self.archive = None
+        if "archive" in options:
+            self.archive = Output.archive_of(options, metas)
+            # structures written after the last checkpoint of an interrupted run, they are not written again
+            self.archived = {Output.tags_key(tags) for _, _, tags in self.archive.index()}
+            return
         self.filenamePattern = join(*(metas["output_prefix"] + options["pattern"]))
         print(self.filenamePattern)
-        self.clean = options.get("clean")
-        self.freeze = self.clean.get("freeze")
-        self.freeze = self.freeze if self.freeze is not None else []
+        extension = splitext(self.filenamePattern)[1][1:]
+        self.format = options.get("format", extension if extension in writers else "mol2")
+        if self.format not in writers:
+            raise ValueError(f"Unknown output format {self.format}, should be one of {list(writers)}")
     
-    def __clean__(self, mol2, tags):
-        atoms_section = atom_section_re.findall(mol2)
-        if self.clean is None:
-            pass
-        rules = self.clean["rules"]
-        if rules is None or len(rules) == 0:
-            obmol = pybel.readstring("mol2", mol2).OBMol
-            constraints = openbabel.OBFFConstraints()
-            to_freezes = (py_.chain(atoms_section[0][0].split("\n"))
-                            .map(lambda line: py_.filter(line.split(" "), lambda token: token != ""))
-                            .filter(lambda line: len(line) != 0)
-                        #  .map(debug_output)
-                            .filter(lambda line: line[1] in self.freeze)
-                            .map(lambda line: int(line[0]))
-                            .value()
-                        )
-            for to_freeze in to_freezes:
-                print(to_freeze)
-                constraints.AddAtomConstraint(to_freeze)
-
-            ff = openbabel.OBForceField.FindForceField("UFF")
-            ff.Setup(obmol, constraints)
-            print("Init:", ff.Energy())
-            ff.ConjugateGradients(self.clean["steps"])
-            print("Optimed", ff.Energy())
-            ff.GetConformers(obmol)
-            output = pybel.Molecule(obmol)
-            output = output.write("mol2")
-            return output
-        else:
-            for [tag, value] in rules:
-                if(tags.get(tag) == value):
-                    print(tags.get(tag))
-                    obmol = pybel.readstring("mol2", mol2).OBMol
-                    constraints = openbabel.OBFFConstraints()
-                    to_freezes = (py_.chain(atoms_section[0][0].split("\n"))
-                                .map(lambda line: py_.filter(line.split(" "), lambda token: token != ""))
-                                .filter(lambda line: len(line) != 0)
-                                #  .map(debug_output)
-                                .filter(lambda line: line[1] in self.freeze)
-                                .map(lambda line: int(line[0]))
-                                .value()
-                                )
-                    for to_freeze in to_freezes:
-                        print(to_freeze)
-                        constraints.AddAtomConstraint(to_freeze)
-
-                    ff = openbabel.OBForceField.FindForceField("UFF")
-                    ff.Setup(obmol, constraints)
-                    print("Init:", ff.Energy())
-                    ff.ConjugateGradients(self.clean["steps"])
-                    print("Optimed", ff.Energy())
-                    ff.GetConformers(obmol)
-                    output = pybel.Molecule(obmol)
-                    output = output.write("mol2")
-                    return output
-            pass
-
-    def __write__(self, target, content):
+    @staticmethod
+    def archive_path(options, metas):
+        if "archive" not in options:
+            return None
+        return normpath(join(*(metas["output_prefix"] + options["archive"])))
+
+    @staticmethod
+    def archive_of(options, metas):
+        rootDirectory = OSFS(metas["rootDirectory"])
+        archive_path = Output.archive_path(options, metas)
+        if dirname(archive_path) != "":
+            rootDirectory.makedirs(dirname(archive_path), recreate=True)
+        return StructureArchive(rootDirectory.getsyspath(archive_path), options.get("format"))
+
+    @staticmethod
+    def tags_key(tags):
+        return json.dumps(tags, sort_keys=True)
+
+    @staticmethod
+    def reset(options, metas):
+        # the archive is only appended, clear the structures of previous runs before workers start
+        if "archive" in options:
+            Output.archive_of(options, metas).reset()
+
+    def __clean__(self, item, tags):
+        if self.stage is None or not self.stage.matches(tags):
+            return None
+        obmol, _, _ = self.stage(item.molecule, tags)
+        return pybel.Molecule(obmol).write(self.format)
+
+    def __write__(self, target, write):
         target_dir = dirname(target)
         if not self.rootDirectory.exists(target_dir):
-            self.rootDirectory.makedirs(target_dir)
-        return self.rootDirectory.writetext(target, content)
+            self.rootDirectory.makedirs(target_dir, recreate=True)
+        with self.rootDirectory.open(target, "w") as file:
+            write(file)
 
     
+    def __append__(self, item, names):
+        if Output.tags_key(names) in self.archived:
+            return item, "output"
+        molecule = item.molecule
+        if self.stage is not None and self.stage.matches(names):
+            _, positions, _ = self.stage(molecule, names)
+            molecule = molecule.with_positions(positions)
+        self.archive.append(molecule, names)
+        return item, "output"
+
     def __call__(self, item, names) -> Any:
-        mol2 = atoms_bonds_to_mol2(item.atoms, item.bonds)
-        cleaned = self.__clean__(mol2, names)
+        if self.archive is not None:
+            return self.__append__(item, names)
+        cleaned = self.__clean__(item, names)
         filename = self.filenamePattern
         for stage_name in names:
             filename = filename.replace(f"{{{stage_name}}}", names[stage_name])
-        # self.__write__(filename, mol2)
         if cleaned is not None:
-            self.__write__(filename, cleaned)
+            self.__write__(filename, lambda file: file.write(cleaned))
         else:
-            self.__write__(filename, mol2)
+            self.__write__(filename, lambda file: writers[self.format](file, item.molecule))
         return item, "output"
 
 default_runners = {
     "add_substitute": (AddSubsititute, True),
+    "combine_substitutes": (CombineSubstitutes, True),
     "modify_atom": (AtomModify, False),
     "modify_bond": (BondModify, False),
     "import": (ImportStructure, False),
+    "optimize": (Optimize, False),
     "output": (Output, False)
 }
\ No newline at end of file
@@ -0,0 +1,57 @@
+from fs.osfs import OSFS
+from layers.EditableLayer import Substitute
+from workflow.cache import digest
+
+
+class SubstituteLibrary:
+    """
+    取代基库: 只扫描一次给定的目录, 每个取代基只读取并解析一次
+
+    同名文件以左侧目录中的为准。同一进程中相同目录列表共享一个库(`shared`), 在进程池创建前加载的取代基会被子进程继承。
+    库不会检查文件在加载后的修改。
+    """
+
+    libraries = {}
+
+    @staticmethod
+    def shared(directories):
+        key = tuple(directories)
+        if key not in SubstituteLibrary.libraries:
+            SubstituteLibrary.libraries[key] = SubstituteLibrary(directories)
+        return SubstituteLibrary.libraries[key]
+
+    def __init__(self, directories) -> None:
+        self.files = {}
+        for directory in [OSFS(directory) for directory in directories]:
+            for filename in directory.listdir("."):
+                if filename.endswith(".mol2"):
+                    self.files.setdefault(filename[0:-5], directory)
+        self.substitutes = {}
+        self.__digest = None
+
+    def names(self):
+        return list(self.files.keys())
+
+    def get(self, substitute_name):
+        substitute = self.substitutes.get(substitute_name)
+        if substitute is None:
+            directory = self.files.get(substitute_name)
+            if directory is None:
+                raise FileNotFoundError(f"No {substitute_name}.mol2 found in given directories")
+            substitute = Substitute.from_mol2(directory.readtext(f"{substitute_name}.mol2"))
+            self.substitutes[substitute_name] = substitute
+        return substitute
+
+    def load(self, substitute_names):
+        for substitute_name in substitute_names:
+            self.get(substitute_name)
+
+    def digest(self):
+        """
+        全部取代基文件内容的哈希, 用于workflow的阶段缓存
+        """
+        if self.__digest is None:
+            self.__digest = digest(*(
+                [name, directory.readbytes(f"{name}.mol2")] for name, directory in sorted(self.files.items())
+            ))
+        return self.__digest